@@ -0,0 +1,118 @@
+"""Measure recording download throughput and the server's CPU time per MB served.
+
+Run it on the Pi (so the stream_control process can be measured) against a recording:
+
+    python benchmarks/download_bench.py recording_1700000000.mp4 --user admin --password secret
+
+It downloads the whole file, then a series of random 1 MB ranges (like scrubbing in a player),
+and prints a JSON summary. Use --pid if stream_control.py is not found automatically.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import time
+import urllib.request
+
+import psutil
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def find_server_pid():
+    for process in psutil.process_iter(['pid', 'cmdline']):
+        cmdline = process.info['cmdline'] or []
+        if any(part.endswith('stream_control.py') for part in cmdline) and process.info['pid'] != os.getpid():
+            return process.info['pid']
+    return None
+
+
+def open_url(url, headers):
+    return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=30)
+
+
+def download(url, headers):
+    # Return (status, bytes read, seconds)
+    started = time.perf_counter()
+    size = 0
+    with open_url(url, headers) as response:
+        status = response.status
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+    return status, size, time.perf_counter() - started
+
+
+def measure(name, server, requests):
+    # Run the (url, headers) requests and return throughput and server CPU per MB
+    cpu_before = server.cpu_times() if server else None
+    total_bytes = 0
+    total_seconds = 0.0
+    statuses = set()
+    for url, headers in requests:
+        status, size, seconds = download(url, headers)
+        statuses.add(status)
+        total_bytes += size
+        total_seconds += seconds
+    result = {
+        "name": name,
+        "requests": len(requests),
+        "statuses": sorted(statuses),
+        "bytes": total_bytes,
+        "seconds": round(total_seconds, 3),
+        "mb_per_second": round(total_bytes / CHUNK_SIZE / total_seconds, 2) if total_seconds else None
+    }
+    if server:
+        cpu_after = server.cpu_times()
+        cpu_seconds = (cpu_after.user - cpu_before.user) + (cpu_after.system - cpu_before.system)
+        result["server_cpu_seconds"] = round(cpu_seconds, 3)
+        result["server_cpu_ms_per_mb"] = round(cpu_seconds * 1000 / (total_bytes / CHUNK_SIZE), 2) if total_bytes else None
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filename', help="recording in the recordings directory")
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="base URL of the web interface")
+    parser.add_argument('--user', help="basic auth user")
+    parser.add_argument('--password', help="basic auth password")
+    parser.add_argument('--ranges', type=int, default=20, help="number of random 1 MB range requests")
+    parser.add_argument('--pid', type=int, help="stream_control.py process to measure")
+    args = parser.parse_args()
+
+    headers = {}
+    if args.user:
+        token = base64.b64encode(f"{args.user}:{args.password or ''}".encode()).decode()
+        headers["Authorization"] = f"Basic {token}"
+    url = f"{args.url.rstrip('/')}/recordings/{args.filename}"
+
+    pid = args.pid or find_server_pid()
+    server = psutil.Process(pid) if pid else None
+    if not server:
+        print("stream_control.py process not found, server CPU is not measured", file=sys.stderr)
+
+    with open_url(url, dict(headers, Range="bytes=0-0")) as response:
+        if response.status != 206:
+            sys.exit(f"Server did not answer a Range request with 206 (got {response.status})")
+        length = int(response.headers["Content-Range"].rsplit('/', 1)[1])
+        etag = response.headers.get("ETag")
+
+    results = [measure("full", server, [(url, headers)])]
+    ranges = []
+    for _ in range(args.ranges):
+        start = random.randrange(0, max(length - CHUNK_SIZE, 1))
+        ranges.append((url, dict(headers, Range=f"bytes={start}-{start + CHUNK_SIZE - 1}")))
+    results.append(measure("random_ranges", server, ranges))
+    if etag:
+        # A matching If-Range gets the range, a stale one the whole file
+        results.append(measure("if_range", server, [(url, dict(headers, Range="bytes=0-1048575", **{"If-Range": etag}))]))
+
+    print(json.dumps({"file": args.filename, "size": length, "etag": etag, "results": results}, indent=4))
+
+
+if __name__ == '__main__':
+    main()
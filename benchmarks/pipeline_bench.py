@@ -0,0 +1,335 @@
+"""Benchmark the stream, record and file stream pipelines without a camera or an RTMP server.
+
+The ffmpeg commands are built by stream_control.py itself, so the benchmark measures exactly what the
+web interface would run. Only the inputs and the destination are swapped:
+
+- /dev/video0 and ALSA become lavfi test sources paced in real time like a camera,
+- RTMP_SERVER points at a local ffmpeg in RTMP listen mode, which records when each packet arrives.
+
+Every combination of the given sizes, frame rates, presets and bitrates is run for --duration seconds:
+
+    python benchmarks/pipeline_bench.py --sizes 1280x720,1920x1080 --rates 30,60 --presets ultrafast,veryfast \\
+        --bitrates 2500,4500 --output results_pi4.json
+
+For each run it reports the achieved fps, encode speed, dropped/duplicated frames, CPU per core, the ffmpeg
+process' CPU and peak memory, and for the stream pipeline the glass-to-ingest latency: the time from a
+frame being generated to the receiver getting it. The receiver runs on the same board, its CPU is listed
+separately. Stop the stream_control service first so it does not compete for the CPU.
+
+The test sources are raw frames, so the camera's USB transfer and MJPEG decode are not part of the numbers.
+"""
+import argparse
+import dataclasses
+import itertools
+import json
+import logging
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from threading import Thread
+
+import psutil
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINES = ('stream', 'record', 'file_stream')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def video_source(size, rate, base_us):
+    # realtime paces the generator like a camera, setpts stamps each frame with the wall clock (in µs since base_us)
+    return f"testsrc2=size={size}:rate={rate},realtime,settb=AVTB,setpts=RTCTIME-{base_us}"
+
+
+def audio_source(base_us):
+    return f"sine=frequency=1000:sample_rate=48000,arealtime,asettb=AVTB,asetpts=RTCTIME-{base_us}"
+
+
+def replace_input(command, input_format, source):
+    # Swap the input opened with -f input_format (from -f up to its -i value) for a lavfi source
+    start = command.index(input_format) - 1
+    end = command.index("-i", start) + 2
+    return command[:start] + ["-f", "lavfi", "-i", source] + command[end:]
+
+
+def benchmark_command(command, size, rate, base_us):
+    command = replace_input(command, "v4l2", video_source(size, rate, base_us))
+    command = replace_input(command, "alsa", audio_source(base_us))
+    # Keep the wall clock timestamps so the receiver can tell how old each packet is
+    return [command[0], "-nostats", "-loglevel", "error", "-progress", "pipe:1", "-stats_period", "0.5", "-copyts"] + command[1:]
+
+
+def read_progress(process, samples):
+    # Collect each ffmpeg -progress block with the time it arrived
+    block = {}
+    for line in process.stdout:
+        key, _, value = line.strip().partition('=')
+        if key == 'progress':
+            samples.append((time.time(), block))
+            block = {}
+        elif key:
+            block[key] = value
+
+
+def read_packets(process, base_us, latencies, video_streams):
+    # Parse the receiver's framecrc lines and record how old each video packet is on arrival
+    time_bases = {}
+    for line in process.stdout:
+        now = time.time()
+        if line.startswith('#tb '):
+            index, _, time_base = line[4:].partition(':')
+            numerator, _, denominator = time_base.strip().partition('/')
+            time_bases[int(index)] = int(numerator) / int(denominator)
+        elif line.startswith('#media_type '):
+            index, _, media_type = line[12:].partition(':')
+            if media_type.strip() == 'video':
+                video_streams.add(int(index))
+        elif not line.startswith('#'):
+            parts = [part.strip() for part in line.split(',')]
+            if len(parts) < 3:
+                continue
+            index = int(parts[0])
+            if video_streams and index not in video_streams:
+                continue
+            pts_seconds = int(parts[2]) * time_bases.get(index, 0.001)
+            latencies.append((now, (now - base_us / 1e6 - pts_seconds) * 1000))
+
+
+def number(block, key):
+    try:
+        return float(block.get(key, '').replace('kbits/s', '').rstrip('x'))
+    except ValueError:
+        return None
+
+
+def median(values):
+    values = [value for value in values if value is not None]
+    return round(statistics.median(values), 2) if values else None
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return round(values[min(int(len(values) * fraction), len(values) - 1)], 2) if values else None
+
+
+def process_cpu_seconds(process):
+    try:
+        times = process.cpu_times()
+        return times.user + times.system + times.children_user + times.children_system
+    except psutil.Error:
+        return None
+
+
+def run_case(stream_control, pipeline, size, rate, preset, bitrate, args, workdir):
+    port = free_port()
+    base_us = int(time.time()) * 1000000
+    config = stream_control.StreamConfig.from_env(dict(
+        os.environ,
+        RTMP_SERVER=f"rtmp://127.0.0.1:{port}/live/",
+        STREAM_KEY="bench",
+        VIDEO_SIZE=size,
+        FRAME_RATE=str(rate),
+        PRESET=preset,
+        BITRATE=str(bitrate),
+        KEYFRAME_INTERVAL=str(rate * 2),
+        AUDIO_OFFSET=os.environ.get('AUDIO_OFFSET') or '0',
+        FORMAT=args.format,
+        ENCODER=args.encoder,
+        RECORD_MODE='fragmented',
+        REPORT=''
+    ))
+    stream_control.apply_config(config)
+
+    if pipeline == 'file_stream':
+        clip = os.path.join(workdir, f"clip_{size}_{rate}_{bitrate}.mp4")
+        if not os.path.exists(clip):
+            subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"testsrc2=size={size}:rate={rate}",
+                            "-f", "lavfi", "-i", "sine=frequency=1000:sample_rate=48000", "-t", str(args.duration + 10),
+                            "-c:v", "libx264", "-preset", "veryfast", "-b:v", f"{bitrate}k", "-g", str(rate * 2), "-pix_fmt", "yuv420p",
+                            "-c:a", "aac", clip], check=True)
+        stream_control.apply_config(dataclasses.replace(config, STREAM_FILE=clip))
+        command, _ = stream_control.build_file_stream_command()
+        command = [command[0], "-nostats", "-loglevel", "error", "-progress", "pipe:1", "-stats_period", "0.5"] + command[1:]
+    elif pipeline == 'record':
+        command, _ = stream_control.build_record_command()
+        command = benchmark_command(command, size, rate, base_us)
+    else:
+        stream_control.stream_tee_recording = args.tee
+        command, _ = stream_control.build_stream_command()
+        command = benchmark_command(command, size, rate, base_us)
+
+    receiver = None
+    latencies = []
+    video_streams = set()
+    if pipeline != 'record':
+        receiver = subprocess.Popen(["ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error", "-copyts",
+                                     "-listen", "1", "-f", "flv", "-i", f"rtmp://127.0.0.1:{port}/live/bench",
+                                     "-c", "copy", "-flush_packets", "1", "-f", "framecrc", "-"],
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        Thread(target=read_packets, args=(receiver, base_us, latencies, video_streams), daemon=True).start()
+        time.sleep(1)  # Let the receiver start listening
+
+    samples = []
+    rss = []
+    psutil.cpu_percent(percpu=True)
+    started = time.time()
+    sender = subprocess.Popen(command, cwd=workdir, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    Thread(target=read_progress, args=(sender, samples), daemon=True).start()
+    sender_process = psutil.Process(sender.pid)
+    receiver_process = psutil.Process(receiver.pid) if receiver else None
+    warmed_up = started + args.warmup
+    sender_cpu = receiver_cpu = None
+    while time.time() < started + args.duration and sender.poll() is None:
+        time.sleep(0.5)
+        try:
+            rss.append(sender_process.memory_info().rss)
+        except psutil.Error:
+            break
+        if sender_cpu is None and time.time() >= warmed_up:
+            # CPU is counted after the warm-up, like the other measurements
+            psutil.cpu_percent(percpu=True)
+            sender_cpu = process_cpu_seconds(sender_process)
+            receiver_cpu = process_cpu_seconds(receiver_process) if receiver_process else None
+            measured_from = time.time()
+    per_core = psutil.cpu_percent(percpu=True)
+    measured = time.time() - measured_from if sender_cpu is not None else None
+    sender_cpu_after = process_cpu_seconds(sender_process)
+    receiver_cpu_after = process_cpu_seconds(receiver_process) if receiver_process else None
+
+    exited = sender.poll()
+    if exited is None:
+        sender.terminate()
+    try:
+        sender.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        sender.kill()
+    errors = sender.stderr.read().strip()
+    if receiver:
+        receiver.terminate()
+        try:
+            receiver.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            receiver.kill()
+
+    steady = [block for arrived, block in samples if arrived >= warmed_up]
+    last = samples[-1][1] if samples else {}
+    out_seconds = (number(last, 'out_time_us') or 0) / 1e6
+    steady_latencies = [latency for arrived, latency in latencies if arrived >= warmed_up]
+    return {
+        "pipeline": pipeline,
+        "video_size": size,
+        "frame_rate": rate,
+        "preset": preset,
+        "bitrate": bitrate,
+        "encoder": stream_control.encoder_info["backend"],
+        "seconds": round(time.time() - started, 1),
+        "fps": median(number(block, 'fps') for block in steady),
+        "speed": median(number(block, 'speed') for block in steady),
+        "drop_frames": number(last, 'drop_frames'),
+        "dup_frames": number(last, 'dup_frames'),
+        "bitrate_kbps": round(number(last, 'total_size') * 8 / 1000 / out_seconds, 1) if out_seconds and number(last, 'total_size') else None,
+        "cpu_percent_per_core": per_core if measured else None,
+        "ffmpeg_cpu_percent": round((sender_cpu_after - sender_cpu) / measured * 100, 1) if measured and sender_cpu_after is not None else None,
+        "receiver_cpu_percent": round((receiver_cpu_after - receiver_cpu) / measured * 100, 1) if measured and receiver_cpu is not None and receiver_cpu_after is not None else None,
+        "max_rss_mb": round(max(rss) / 1024 / 1024, 1) if rss else None,
+        "latency_ms": {
+            "median": median(steady_latencies),
+            "p95": percentile(steady_latencies, 0.95),
+            "packets": len(steady_latencies)
+        } if pipeline == 'stream' else None,
+        "error": (errors[-500:] or f"ffmpeg exited with {exited}") if exited is not None else None
+    }
+
+
+def board_model():
+    try:
+        with open('/proc/device-tree/model', 'r') as file:
+            return file.read().strip('\x00\n')
+    except OSError:
+        return platform.machine()
+
+
+def command_output(command, cwd=None):
+    try:
+        return subprocess.run(command, capture_output=True, text=True, timeout=10, cwd=cwd).stdout.strip()
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pipelines', default='stream', help=f"comma separated, from {', '.join(PIPELINES)}")
+    parser.add_argument('--sizes', default='1280x720', help="comma separated VIDEO_SIZE values")
+    parser.add_argument('--rates', default='30', help="comma separated FRAME_RATE values")
+    parser.add_argument('--presets', default='ultrafast', help="comma separated PRESET values")
+    parser.add_argument('--bitrates', default='4000', help="comma separated BITRATE values in kbps")
+    parser.add_argument('--format', default='mjpeg', help="FORMAT the capture planner assumes")
+    parser.add_argument('--encoder', default='auto', help="ENCODER setting (auto, libx264, h264_v4l2m2m)")
+    parser.add_argument('--tee', action='store_true', help="stream with the local recording copy (Stream & Record tee mode)")
+    parser.add_argument('--duration', type=int, default=30, help="seconds per run")
+    parser.add_argument('--warmup', type=int, default=5, help="seconds at the start of each run left out of the results")
+    parser.add_argument('--output', help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    pipelines = [name.strip() for name in args.pipelines.split(',')]
+    unknown = [name for name in pipelines if name not in PIPELINES]
+    if unknown:
+        sys.exit(f"Unknown pipeline: {', '.join(unknown)}")
+
+    output = os.path.abspath(args.output) if args.output else None
+    # stream_control keeps its state, jobs and recordings in the working directory, so give it a scratch one
+    workdir = tempfile.mkdtemp(prefix='pipeline_bench_')
+    os.makedirs(os.path.join(workdir, 'recordings'))
+    # Read at import; the audio input is replaced by a test source anyway
+    with open(os.path.join(workdir, 'audio_device.txt'), 'w') as file:
+        file.write('bench')
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import stream_control
+    # Keep the benchmark's debug output out of the service log
+    logging.getLogger().handlers = [logging.NullHandler()]
+    stream_control.apply_config(stream_control.StreamConfig.from_env(dict(os.environ, ENCODER=args.encoder)))
+    stream_control.encoder_info = stream_control.probe_encoders()
+
+    results = []
+    matrix = list(itertools.product(pipelines, args.sizes.split(','), [int(rate) for rate in args.rates.split(',')],
+                                    args.presets.split(','), [int(bitrate) for bitrate in args.bitrates.split(',')]))
+    for run_number, (pipeline, size, rate, preset, bitrate) in enumerate(matrix, 1):
+        print(f"[{run_number}/{len(matrix)}] {pipeline} {size} {rate} fps {preset} {bitrate} kbps", file=sys.stderr)
+        try:
+            results.append(run_case(stream_control, pipeline, size.strip(), rate, preset.strip(), bitrate, args, workdir))
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            results.append({"pipeline": pipeline, "video_size": size, "frame_rate": rate, "preset": preset, "bitrate": bitrate, "error": str(e)})
+
+    report = {
+        "board": board_model(),
+        "platform": platform.platform(),
+        "cpu_count": psutil.cpu_count(),
+        "ffmpeg": (command_output(["ffmpeg", "-version"]) or '').split('\n')[0],
+        "revision": command_output(["git", "describe", "--always", "--dirty"], cwd=REPO_DIR),
+        "encoder": stream_control.encoder_info["reason"],
+        "date": datetime.now().isoformat(timespec='seconds'),
+        "duration": args.duration,
+        "warmup": args.warmup,
+        "results": results
+    }
+    data = json.dumps(report, indent=4)
+    if output:
+        with open(output, 'w') as file:
+            file.write(data)
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
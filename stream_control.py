@@ -1,3 +1,4 @@
+import sys
 import time
 import json
 import re
@@ -5,12 +6,26 @@ import subprocess
 import os
 import logging
 import glob
+import hashlib
+import random
+import shutil
+import sqlite3
+import mimetypes
+import fcntl
+import struct
 import psutil
+from collections import deque
 from dotenv import load_dotenv
-from flask import Flask, request, render_template, jsonify, send_file, abort
+from flask import Flask, Response, request, render_template, jsonify, send_file, abort, g
 from flask_basicauth import BasicAuth
-from threading import Thread, Event, Timer
+from threading import Thread, Event, Timer, RLock, Condition, current_thread
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from dataclasses import dataclass, field, fields, replace
+from typing import Optional
+
+# Used for the startup timing breakdown
+startup_started = time.time()
 
 # Flask application
 app = Flask(__name__)
@@ -62,30 +77,192 @@ def force_basic_auth():
         if not basic_auth.authenticate():
             return basic_auth.challenge()
 
+# Upper bounds (seconds) of the request latency histogram buckets exported on /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# route -> {"buckets": [...], "count": n, "sum": seconds}
+request_latency = {}
+request_latency_lock = RLock()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    start = g.get('request_start')
+    if start is not None:
+        elapsed = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        with request_latency_lock:
+            stats = request_latency.setdefault(route, {"buckets": [0] * len(LATENCY_BUCKETS), "count": 0, "sum": 0.0})
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    stats["buckets"][i] += 1
+            stats["count"] += 1
+            stats["sum"] += elapsed
+    return response
+
 stop_event = Event()
 
-# RTMP stream settings
-STREAM_KEY = os.getenv('STREAM_KEY')
-RTMP_SERVER = os.getenv('RTMP_SERVER')
-
-# ALSA audio source
-ALSA_AUDIO_SOURCE = os.getenv('ALSA_AUDIO_SOURCE')
-
-# Stream Settings
-VIDEO_SIZE = os.getenv('VIDEO_SIZE')
-FRAME_RATE = int(os.getenv('FRAME_RATE'))
-BITRATE = int(os.getenv('BITRATE'))
-KEYFRAME_INTERVAL = int(os.getenv('KEYFRAME_INTERVAL'))
-AUDIO_OFFSET = os.getenv('AUDIO_OFFSET')
-STREAM_M3U8_URL = os.getenv('STREAM_M3U8_URL')
-STREAM_FILE = os.getenv('STREAM_FILE')  # Add STREAM_FILE variable
-FORMAT = os.getenv('FORMAT')
-PRESET = os.getenv('PRESET')
-REPORT = os.getenv('REPORT')
-MAX_TIME = os.getenv('MAX_TIME')
-
-# Calculate buffer size and keyframe interval
-BUFFER_SIZE = BITRATE * 2  # in kbps
+# Hardware discovery runs in the background after the web server has started (see run_discovery)
+discovery = {"status": "discovering", "timings": {}}
+discovery_complete = Event()
+# Seconds a pipeline start waits for discovery before using the defaults
+DISCOVERY_TIMEOUT = 30
+
+@dataclass(frozen=True)
+class StreamConfig:
+    # Settings from .env, converted and checked once when loaded
+    # RTMP stream settings
+    STREAM_KEY: Optional[str] = None
+    RTMP_SERVER: Optional[str] = None
+    # ALSA audio source
+    ALSA_AUDIO_SOURCE: Optional[str] = None
+    # Stream Settings
+    VIDEO_SIZE: Optional[str] = None
+    FRAME_RATE: int = 30
+    BITRATE: int = 4000
+    KEYFRAME_INTERVAL: int = 30
+    AUDIO_OFFSET: Optional[str] = None
+    STREAM_M3U8_URL: Optional[str] = None
+    STREAM_FILE: Optional[str] = None
+    FORMAT: Optional[str] = None
+    PRESET: Optional[str] = None
+    REPORT: Optional[str] = None
+    MAX_TIME: Optional[str] = None
+    # Stream & Record mode: "tee" encodes once and writes the RTMP stream and a local copy,
+    # "hls" records the published stream back from STREAM_M3U8_URL
+    STREAM_RECORD_MODE: Optional[str] = None
+    # Length in seconds of each local recording segment
+    RECORD_SEGMENT_TIME: int = 600
+    # How recordings are written: "fragmented" MP4 or "segment" files are playable as soon as ffmpeg exits,
+    # "remux" writes a plain MP4 and fixes it up with a second pass after stopping
+    RECORD_MODE: str = 'fragmented'
+    # Video encoder: "auto" uses the hardware encoder when ffmpeg and the board both have one
+    ENCODER: str = 'auto'
+    # H.264 profile requested from the encoder
+    ENCODER_PROFILE: str = 'high'
+    # "auto" lets the capture planner switch format when FORMAT cannot deliver VIDEO_SIZE at FRAME_RATE
+    CAPTURE_PATH: str = 'auto'
+    # Give up after this many restarts in a row without a stable run (0 keeps retrying forever)
+    RESTART_MAX_ATTEMPTS: int = field(default=0, metadata={'min': 0})
+    # Seconds to batch state.json writes for. 0 writes on every transition.
+    STATE_FLUSH_DELAY: float = field(default=0.0, metadata={'min': 0})
+    # Extra mount points to report alongside the recordings directory (comma separated)
+    DISK_MOUNTS: str = '/,/media/usb0,/media/usb1'
+    # Background jobs run at the same time. More than one competes with a live encoder for the SD card.
+    JOB_WORKERS: int = 1
+    # CPU and I/O priority of job ffmpeg processes (nice 0-19, ionice class 2 = best-effort with level 0-7, 3 = idle)
+    JOB_NICE: int = field(default=10, metadata={'min': 0})
+    JOB_IONICE_CLASS: int = 2
+    JOB_IONICE_LEVEL: int = field(default=7, metadata={'min': 0})
+    # ffmpeg threads per job; stream copy gains nothing from more
+    JOB_THREADS: int = 1
+    # Download speed cap in KB/s while a stream is live, so downloads leave the uplink to the RTMP upload. 0 disables it.
+    DOWNLOAD_RATE_LIMIT: int = field(default=0, metadata={'min': 0})
+    # While a pipeline is running, thumbnails are only made when total CPU usage is below this (percent)
+    THUMBNAIL_MAX_CPU: float = field(default=50.0, metadata={'min': 0})
+    # Media library files that do not match this size and frame rate are normalized to it
+    MEDIA_VIDEO_SIZE: str = '1280x720'
+    MEDIA_FRAME_RATE: int = 30
+    # Adaptive bitrate: step the stream's bitrate (and optionally its resolution) down when the uplink cannot keep up
+    ADAPTIVE_BITRATE: bool = False
+    # Lowest bitrate (kbps) to step down to
+    ADAPTIVE_MIN_BITRATE: int = 800
+    # Also lower the resolution on the lower steps (1080p -> 720p -> 480p)
+    ADAPTIVE_RESOLUTION: bool = False
+    # Seconds clear before stepping back up
+    ADAPTIVE_UP_AFTER: int = 60
+    # First local UDP port the stream encoder sends to when simulcasting, one per destination
+    SIMULCAST_BASE_PORT: int = field(default=15000, metadata={'min': 1024})
+    # Reload uvcvideo even when the device looks healthy after this many capture pipeline failures in a row
+    DEVICE_RELOAD_AFTER_FAILURES: int = 3
+
+    @classmethod
+    def from_env(cls, env):
+        # Raises ValueError naming the invalid setting
+        values = {}
+        for setting in fields(cls):
+            value = env.get(setting.name)
+            # Unset (or empty, for settings with a default) keeps the default
+            if value is None or (value == '' and setting.default is not None):
+                continue
+            if setting.type in (int, float):
+                try:
+                    value = setting.type(value)
+                except ValueError:
+                    kind = "a whole number" if setting.type is int else "a number"
+                    raise ValueError(f"{setting.name} must be {kind}, got '{value}'.")
+                minimum = setting.metadata.get('min', 1)
+                if value < minimum:
+                    raise ValueError(f"{setting.name} must be greater than 0." if minimum == 1 else f"{setting.name} must be at least {minimum}.")
+            elif setting.type is bool:
+                if value.lower() not in ('1', 'true', 'yes', '0', 'false', 'no'):
+                    raise ValueError(f"{setting.name} must be true or false, got '{value}'.")
+                value = value.lower() in ('1', 'true', 'yes')
+            values[setting.name] = value
+        config = cls(**values)
+        config.validate()
+        return config
+
+    def validate(self):
+        if self.VIDEO_SIZE and not re.fullmatch(r'\d+x\d+', self.VIDEO_SIZE):
+            raise ValueError(f"VIDEO_SIZE must look like 1920x1080, got '{self.VIDEO_SIZE}'.")
+        if not re.fullmatch(r'\d+x\d+', self.MEDIA_VIDEO_SIZE):
+            raise ValueError(f"MEDIA_VIDEO_SIZE must look like 1280x720, got '{self.MEDIA_VIDEO_SIZE}'.")
+        if self.AUDIO_OFFSET:
+            try:
+                float(self.AUDIO_OFFSET)
+            except ValueError:
+                raise ValueError(f"AUDIO_OFFSET must be a number of seconds, got '{self.AUDIO_OFFSET}'.")
+        if self.MAX_TIME and not re.fullmatch(r'\d+:\d{1,2}(:\d{1,2})?', self.MAX_TIME):
+            raise ValueError(f"MAX_TIME must look like HH:MM, got '{self.MAX_TIME}'.")
+        if self.STREAM_RECORD_MODE not in (None, '', 'tee', 'hls'):
+            raise ValueError(f"STREAM_RECORD_MODE must be tee or hls, got '{self.STREAM_RECORD_MODE}'.")
+        if self.RECORD_MODE not in ('fragmented', 'segment', 'remux'):
+            raise ValueError(f"RECORD_MODE must be fragmented, segment or remux, got '{self.RECORD_MODE}'.")
+        if self.CAPTURE_PATH not in ('auto', 'manual'):
+            raise ValueError(f"CAPTURE_PATH must be auto or manual, got '{self.CAPTURE_PATH}'.")
+        if self.JOB_NICE > 19:
+            raise ValueError(f"JOB_NICE must be between 0 and 19, got {self.JOB_NICE}.")
+        if self.JOB_IONICE_CLASS > 3:
+            raise ValueError(f"JOB_IONICE_CLASS must be 1, 2 or 3, got {self.JOB_IONICE_CLASS}.")
+        if self.JOB_IONICE_LEVEL > 7:
+            raise ValueError(f"JOB_IONICE_LEVEL must be between 0 and 7, got {self.JOB_IONICE_LEVEL}.")
+        if self.SIMULCAST_BASE_PORT > 65000:
+            raise ValueError(f"SIMULCAST_BASE_PORT must be between 1024 and 65000, got {self.SIMULCAST_BASE_PORT}.")
+        if self.THUMBNAIL_MAX_CPU > 100:
+            raise ValueError(f"THUMBNAIL_MAX_CPU must be a percentage up to 100, got {self.THUMBNAIL_MAX_CPU}.")
+
+def apply_config(config):
+    # Publish the config as the module-level settings the command builders use
+    global current_config, STREAM_KEY, RTMP_SERVER, ALSA_AUDIO_SOURCE, VIDEO_SIZE, FRAME_RATE, BITRATE, KEYFRAME_INTERVAL, AUDIO_OFFSET, BUFFER_SIZE, STREAM_M3U8_URL, STREAM_FILE, FORMAT, PRESET, REPORT, MAX_TIME, STREAM_RECORD_MODE, RECORD_SEGMENT_TIME, RECORD_MODE, ENCODER, ENCODER_PROFILE, CAPTURE_PATH
+    current_config = config
+    STREAM_KEY = config.STREAM_KEY
+    RTMP_SERVER = config.RTMP_SERVER
+    ALSA_AUDIO_SOURCE = config.ALSA_AUDIO_SOURCE
+    VIDEO_SIZE = config.VIDEO_SIZE
+    FRAME_RATE = config.FRAME_RATE
+    BITRATE = config.BITRATE
+    KEYFRAME_INTERVAL = config.KEYFRAME_INTERVAL
+    AUDIO_OFFSET = config.AUDIO_OFFSET
+    STREAM_M3U8_URL = config.STREAM_M3U8_URL
+    STREAM_FILE = config.STREAM_FILE
+    FORMAT = config.FORMAT
+    PRESET = config.PRESET
+    REPORT = config.REPORT
+    MAX_TIME = config.MAX_TIME
+    STREAM_RECORD_MODE = config.STREAM_RECORD_MODE
+    RECORD_SEGMENT_TIME = config.RECORD_SEGMENT_TIME
+    RECORD_MODE = config.RECORD_MODE
+    ENCODER = config.ENCODER
+    ENCODER_PROFILE = config.ENCODER_PROFILE
+    CAPTURE_PATH = config.CAPTURE_PATH
+    # Calculate buffer size
+    BUFFER_SIZE = BITRATE * 2  # in kbps
+
+apply_config(StreamConfig.from_env(os.environ))
 
 def get_device_value():
     device_file = "audio_device.txt"
@@ -96,8 +273,7 @@ def get_device_value():
         logging.debug("audio_device.txt file not found")
         exit(1)
 
-def get_audio_device(device_value):
-    arecord_output = subprocess.run(['arecord', '-l'], capture_output=True, text=True).stdout
+def get_audio_device(device_value, arecord_output):
     for line in arecord_output.splitlines():
         if device_value in line:
             card_match = re.search(r'card\s+(\d+):', line)
@@ -115,60 +291,69 @@ def get_audio_device(device_value):
                 logging.debug(line)
     return None
 
-def update_env_file(audio_device):
+# Held for every read-modify-write of .env (the settings form and audio device discovery)
+env_file_lock = RLock()
+
+def write_env_file(lines):
+    # Write a copy and swap it in, so a crash or full disk never leaves a truncated .env
+    tmp_file = '.env.tmp'
+    with open(tmp_file, 'w') as env_file:
+        env_file.writelines(lines)
+        env_file.flush()
+        os.fsync(env_file.fileno())
+    os.replace(tmp_file, '.env')
+
+def update_env_audio_device(audio_device):
     env_file = ".env"
-    if os.path.isfile(env_file):
-        with open(env_file, "r") as file:
-            lines = file.readlines()
-        
-        with open(env_file, "w") as file:
-            updated = False
-            for line in lines:
-                if line.startswith("ALSA_AUDIO_SOURCE="):
-                    file.write(f"ALSA_AUDIO_SOURCE={audio_device}\n")
-                    updated = True
-                else:
-                    file.write(line)
-            if not updated:
-                file.write(f"ALSA_AUDIO_SOURCE={audio_device}\n")
+    with env_file_lock:
+        lines = []
+        if os.path.isfile(env_file):
+            with open(env_file, "r") as file:
+                lines = file.readlines()
+        updated = False
+        for index, line in enumerate(lines):
+            if line.startswith("ALSA_AUDIO_SOURCE="):
+                lines[index] = f"ALSA_AUDIO_SOURCE={audio_device}\n"
+                updated = True
+        if not updated:
+            if lines and not lines[-1].endswith("\n"):
+                lines[-1] += "\n"
+            lines.append(f"ALSA_AUDIO_SOURCE={audio_device}\n")
+        write_env_file(lines)
+
+def apply_audio_device(arecord_output):
+    audio_device = get_audio_device(device_value, arecord_output)
+    if device_value and audio_device:
+        update_env_audio_device(audio_device)
+        logging.debug(f"Updated .env file with ALSA_AUDIO_SOURCE={audio_device}")
+        os.environ['ALSA_AUDIO_SOURCE'] = audio_device
+        apply_config(replace(current_config, ALSA_AUDIO_SOURCE=audio_device))
     else:
-        with open(env_file, "w") as file:
-            file.write(f"ALSA_AUDIO_SOURCE={audio_device}\n")
+        logging.debug("No suitable audio device found")
 
-# Update audio device
+# The audio device itself is looked up during hardware discovery (see run_discovery)
 device_value = get_device_value()
-audio_device = get_audio_device(device_value)
-if device_value and audio_device:
-    update_env_file(audio_device)
-    logging.debug(f"Updated .env file with ALSA_AUDIO_SOURCE={audio_device}")
-    ALSA_AUDIO_SOURCE = audio_device
-else:
-    logging.debug("No suitable audio device found")
 
 # Define the output file
 SYS_INFO_FILE = "system_info.txt"
 
-# Truncate the output file (or create it if it doesn't exist)
-with open(SYS_INFO_FILE, "w") as file:
-    pass
-
-def append_command_output(command, description):
-    with open(SYS_INFO_FILE, "a") as file:
-        file.write(f"Output of {description}:\n")
-        result = subprocess.run(command, capture_output=True, text=True)
-        file.write(result.stdout)
-        file.write("\n\n")
-
-# Run lsusb and append the output to the file
-append_command_output(["lsusb"], "lsusb")
-
-# Run arecord -l and append the output to the file
-append_command_output(["arecord", "-l"], "arecord -l")
-
-# Run v4l2-ctl --list-formats-ext and append the output to the file
-append_command_output(["v4l2-ctl", "--list-formats-ext"], "v4l2-ctl --list-formats-ext")
-
-logging.debug(f"System information saved to {SYS_INFO_FILE}")
+def get_command_output(command):
+    try:
+        return subprocess.run(command, capture_output=True, text=True, timeout=15).stdout
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logging.error(f"Failed to run {' '.join(command)}: {e}")
+        return ''
+
+def write_system_info(outputs):
+    # Write in one go so readers never see a half-written file
+    tmp_file = f"{SYS_INFO_FILE}.tmp"
+    with open(tmp_file, "w") as file:
+        for description, output in outputs:
+            file.write(f"Output of {description}:\n")
+            file.write(output)
+            file.write("\n\n")
+    os.replace(tmp_file, SYS_INFO_FILE)
+    logging.debug(f"System information saved to {SYS_INFO_FILE}")
 
 def parse_v4l2_data_from_file(file_path):
     formats = []
@@ -205,6 +390,133 @@ def parse_v4l2_data_from_file(file_path):
 
     return formats, resolutions
 
+# v4l2 pixel format codes and the names ffmpeg's -input_format expects
+V4L2_FORMAT_NAMES = {"yuyv": "yuyv422", "mjpg": "mjpeg", "yu12": "yuv420p", "uyvy": "uyvy422", "rgb3": "rgb24"}
+
+def parse_v4l2_modes(content):
+    # v4l2-ctl --list-formats-ext output as {format: {size: [fps]}}
+    modes = {}
+    current_format = None
+    current_size = None
+    for line in content.splitlines():
+        format_match = re.search(r"\[\d+\]:\s+'([^']+)'", line)
+        if format_match:
+            name = format_match.group(1).lower()
+            current_format = modes.setdefault(V4L2_FORMAT_NAMES.get(name, name), {})
+            current_size = None
+            continue
+        size_match = re.search(r"Size:\s+Discrete\s+(\d+x\d+)", line)
+        if size_match and current_format is not None:
+            current_size = current_format.setdefault(size_match.group(1).lower(), [])
+            continue
+        interval_match = re.search(r"Interval:\s+Discrete\s+[\d.]+s\s+\(([\d.]+)\s+fps\)", line)
+        if interval_match and current_size is not None:
+            fps = float(interval_match.group(1))
+            if fps not in current_size:
+                current_size.append(fps)
+    return modes
+
+def parse_v4l2_modes_from_file(file_path):
+    try:
+        with open(file_path, "r") as file:
+            content = file.read()
+    except OSError:
+        return {}
+    v4l2_start = content.find("Output of v4l2-ctl --list-formats-ext:")
+    if v4l2_start == -1:
+        return {}
+    return parse_v4l2_modes(content[v4l2_start:])
+
+# Capture device used by the pipelines, and where its parsed capabilities are cached
+VIDEO_DEVICE = '/dev/video0'
+CAPABILITIES_CACHE_FILE = 'capabilities.json'
+
+def read_sysfs_value(path):
+    try:
+        with open(path, 'r') as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+def get_device_identity(device, sysfs_root='/sys/class/video4linux'):
+    # Name plus USB ids and firmware: survives renumbering, refreshed after a firmware update
+    device_dir = os.path.join(sysfs_root, os.path.basename(device))
+    name = read_sysfs_value(os.path.join(device_dir, 'name'))
+    if name is None:
+        return None
+
+    usb = {}
+    path = os.path.realpath(os.path.join(device_dir, 'device'))
+    while path not in ('/', '') and not os.path.isfile(os.path.join(path, 'idVendor')):
+        path = os.path.dirname(path)
+    if os.path.isfile(os.path.join(path, 'idVendor')):
+        for key in ('idVendor', 'idProduct', 'serial', 'bcdDevice'):
+            usb[key] = read_sysfs_value(os.path.join(path, key))
+
+    return "|".join([name] + [f"{key}={value}" for key, value in usb.items() if value])
+
+def list_capture_devices(sysfs_root='/sys/class/video4linux'):
+    # UVC capture nodes only, no metadata nodes or SoC codec/ISP devices
+    devices = []
+    for device_dir in sorted(glob.glob(os.path.join(sysfs_root, 'video*'))):
+        if read_sysfs_value(os.path.join(device_dir, 'index')) not in (None, '0'):
+            continue
+        if '/usb' not in os.path.realpath(os.path.join(device_dir, 'device')):
+            continue
+        devices.append(f"/dev/{os.path.basename(device_dir)}")
+    return devices
+
+def probe_device_modes(device):
+    try:
+        output = subprocess.run(["v4l2-ctl", "-d", device, "--list-formats-ext"], capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logging.error(f"Failed to list formats for {device}: {e}")
+        return {}
+    return parse_v4l2_modes(output)
+
+def build_capability_index(default_modes, cache_file=CAPABILITIES_CACHE_FILE):
+    # {device: {identity, name, formats}}, only probing devices not in the cache
+    try:
+        with open(cache_file, 'r') as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        cache = {}
+
+    index = {}
+    cache_changed = False
+    for device in list_capture_devices():
+        identity = get_device_identity(device)
+        if identity and identity in cache:
+            formats = cache[identity]["formats"]
+        else:
+            formats = probe_device_modes(device)
+            if identity and formats:
+                cache[identity] = {"formats": formats, "probed_at": time.time()}
+                cache_changed = True
+        index[device] = {"identity": identity, "name": identity.split('|')[0] if identity else None, "formats": formats}
+
+    if VIDEO_DEVICE not in index:
+        # No sysfs information (or not a USB device): fall back to the v4l2-ctl dump for the default device
+        index[VIDEO_DEVICE] = {"identity": None, "name": None, "formats": default_modes()}
+
+    if cache_changed:
+        tmp_file = f"{cache_file}.tmp"
+        try:
+            with open(tmp_file, 'w') as file:
+                json.dump(cache, file, indent=4)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            logging.error(f"Failed to write {cache_file}: {e}")
+
+    return index
+
+# Modes from the previous run's system info until discovery has finished
+capability_index = {VIDEO_DEVICE: {"identity": None, "name": None, "formats": parse_v4l2_modes_from_file(SYS_INFO_FILE)}}
+
+def get_device_modes(device=VIDEO_DEVICE):
+    return capability_index.get(device, {}).get("formats") or {}
+
+
 # Remove old ffmpeg logs
 def remove_ffmpeg_logs(directory):
     # Create a pattern to match the ffmpeg log files
@@ -236,140 +548,496 @@ def get_latest_ffmpeg_log(directory):
     
     return latest_file
 
-# Remove old ffmpeg log files
-remove_ffmpeg_logs(current_directory)
+# Size of each backwards read when tailing a log file
+LOG_TAIL_BLOCK_SIZE = 8192
+# Most bytes returned by one incremental log read; older bytes are skipped
+LOG_CHUNK_LIMIT = 65536
 
 def get_last_n_lines(file_path, n):
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
+    # Read backwards from the end in blocks
+    with open(file_path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        position = file.tell()
+        data = b''
+        # One extra newline so a trailing partial line is still counted
+        while position > 0 and data.count(b'\n') <= n:
+            read_size = min(LOG_TAIL_BLOCK_SIZE, position)
+            position -= read_size
+            file.seek(position)
+            data = file.read(read_size) + data
+    lines = data.decode('utf-8', errors='replace').splitlines(keepends=True)
     return lines[-n:]
 
-def get_cpu_usage():
-    # Get the CPU usage percentage
-    cpu_usage = psutil.cpu_percent(interval=1)
-    return cpu_usage
+def read_log_since(file_path, offset):
+    # (text, new offset, reset); reset means the file is new, truncated or too far ahead
+    size = os.path.getsize(file_path)
+    if offset is None or offset > size:
+        # New or truncated file, start again from the last 100 lines
+        return ''.join(get_last_n_lines(file_path, 100)), size, True
+    if offset == size:
+        return '', offset, False
+
+    reset = False
+    if size - offset > LOG_CHUNK_LIMIT:
+        offset = size - LOG_CHUNK_LIMIT
+        reset = True
+
+    with open(file_path, 'rb') as file:
+        file.seek(offset)
+        data = file.read(size - offset)
+
+    if reset:
+        # Drop the partial line left by skipping ahead
+        data = data[data.find(b'\n') + 1:]
+    return data.decode('utf-8', errors='replace'), size, reset
+
+def get_log_response(file_path):
+    # ?since=<offset> only returns bytes appended after offset
+    since = request.args.get('since', type=int)
+    if since is None:
+        log_content = ''.join(get_last_n_lines(file_path, 100))
+        return jsonify({'log': log_content, 'offset': os.path.getsize(file_path), 'reset': True})
+
+    log_content, offset, reset = read_log_since(file_path, since)
+    return jsonify({'log': log_content, 'offset': offset, 'reset': reset})
 
 def get_memory_usage():
     # Get the memory usage details
     memory_info = psutil.virtual_memory()
     return memory_info.percent, memory_info.available, memory_info.total
 
-def display_usage():
-    cpu_usage = get_cpu_usage()
-    memory_usage_percent, memory_available, memory_total = get_memory_usage()
-
-    usage_data = {
-        "cpu_usage": cpu_usage,
-        "memory_usage_percent": memory_usage_percent,
-        "memory_available_mb": memory_available / (1024 * 1024),
-        "memory_total_mb": memory_total / (1024 * 1024)
-    }
-
-    usage_json = json.dumps(usage_data, indent=4)
-    return usage_json
+def get_cpu_temperature():
+    # Raspberry Pi OS exposes the SoC temperature in millidegrees Celsius
+    try:
+        with open('/sys/class/thermal/thermal_zone0/temp', 'r') as file:
+            return int(file.read().strip()) / 1000
+    except (OSError, ValueError):
+        return None
 
-def disk_usage():
+# Bits reported by the firmware get_throttled value (same as `vcgencmd get_throttled`)
+THROTTLE_FLAGS = {
+    0: "under_voltage",
+    1: "arm_frequency_capped",
+    2: "throttled",
+    3: "soft_temperature_limit",
+    16: "under_voltage_occurred",
+    17: "arm_frequency_capped_occurred",
+    18: "throttled_occurred",
+    19: "soft_temperature_limit_occurred"
+}
+
+def get_throttled_state():
+    # Read from sysfs so sampling does not fork vcgencmd every second
     try:
-        # Run df -h and capture the output
-        result = subprocess.run(['df', '-h'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-        if result.returncode != 0:
-            raise Exception("Error getting disk usage: " + result.stderr.decode())
-            
-        output = result.stdout.decode()
-        
-        # Parse the output (assuming you want the second partition)
-        lines = output.split('\n')
-        usb_device = range(8, len(lines))
-        sd_card = range(1, len(lines))
-        
-        for i in usb_device:
-            parts = lines[i].split()
-            if len(parts) > 5:
-                filesystem = parts[0]
-                size = parts[1]
-                used = parts[2]
-                available = parts[3]
-                use_percentage = parts[4]
-                mounted_on = parts[5]
-                
-                # Check if the filesystem matches /dev/sda1
-                if filesystem == '/dev/sda1':
-                    return {
-                        "filesystem": filesystem,
-                        "size": size,
-                        "used": used,
-                        "available": available,
-                        "use_percentage": use_percentage + "%",
-                        "mounted_on": mounted_on
-                    }
-        
-        for i in sd_card:
-            parts = lines[i].split()
-            if len(parts) > 5:
-                filesystem = parts[0]
-                size = parts[1]
-                used = parts[2]
-                available = parts[3]
-                use_percentage = parts[4]
-                mounted_on = parts[5]
-                
-                # Check if the filesystem matches /dev/mmcblk0p2
-                if filesystem == '/dev/mmcblk0p2':
-                    return {
-                        "filesystem": filesystem,
-                        "size": size,
-                        "used": used,
-                        "available": available,
-                        "use_percentage": use_percentage + "%",
-                        "mounted_on": mounted_on
-                    }
-        
+        with open('/sys/devices/platform/soc/soc:firmware/get_throttled', 'r') as file:
+            value = int(file.read().strip(), 16)
+    except (OSError, ValueError):
+        return None
+    return {"value": hex(value), "flags": [name for bit, name in THROTTLE_FLAGS.items() if value & (1 << bit)]}
+
+# Seconds between system samples and how many samples to keep for /get_cpu_stats?window=
+SAMPLE_INTERVAL = 1
+SAMPLE_HISTORY = 300
+
+class SystemSampler:
+    # Samples host stats in the background so requests never block on psutil
+
+    def __init__(self, interval=SAMPLE_INTERVAL, history=SAMPLE_HISTORY):
+        self.interval = interval
+        self._samples = deque(maxlen=history)
+        self._lock = RLock()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        # Prime the counters so the first sample covers a real interval
+        psutil.cpu_percent(interval=None)
+        psutil.cpu_percent(interval=None, percpu=True)
+        self._thread = Thread(target=self._run, name="system-sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                sample = self.take_sample()
+                with self._lock:
+                    self._samples.append(sample)
+            except Exception as e:
+                logging.error(f"Error sampling system usage: {e}")
+
+    def take_sample(self):
+        memory_usage_percent, memory_available, memory_total = get_memory_usage()
         return {
-            "error": "No matching filesystem found"
+            "timestamp": time.time(),
+            "cpu_usage": psutil.cpu_percent(interval=None),
+            "cpu_per_core": psutil.cpu_percent(interval=None, percpu=True),
+            "memory_usage_percent": memory_usage_percent,
+            "memory_available_mb": memory_available / (1024 * 1024),
+            "memory_total_mb": memory_total / (1024 * 1024),
+            "temperature_c": get_cpu_temperature(),
+            "throttled": get_throttled_state()
         }
-    
-    except Exception as e:
-        return {'error': str(e)}
-    
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
 
-def remux(input_file, output_file):
-    try:
-        remux_command = [
-            "ffmpeg",
-            "-y",  # Overwrite output file without prompt
-            "-i", input_file,  # Input file
-            "-c", "copy",  # Copy both audio and video streams
-            "-f", "mp4",  # Output format
-            "-nostats",  # Disable statistics display
-            "-threads", "4",  # Use 4 threads for encoding
-            output_file  # Output file
-        ]
-        subprocess.run(remux_command, check=True)
-        logging.debug(f"Remuxed file {input_file} to {output_file}")
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Remuxing failed for {input_file}: {e}")
+    def latest(self):
+        with self._lock:
+            if self._samples:
+                return dict(self._samples[-1])
+        return self.take_sample()
 
-def remux_and_finalize(recording_file):
-    """Remuxes the recording file and updates the state when done."""
-    try:
-        logging.debug(f"Remuxing {recording_file} in background...")
-        remux_file = recording_file.replace('.mp4', '_remuxed.mp4')
-        remux(recording_file, remux_file)
-        os.remove(recording_file)
-        os.rename(remux_file, recording_file)
-        logging.debug(f"Successfully remuxed and replaced: {recording_file}")
-    except Exception as e:
-        logging.error(f"Error during remux and finalize: {e}")
-    finally:
-        # Update state to indicate remuxing is complete
-        state = load_state()
-        state["remux"] = False
-        save_state(state)
-        logging.debug("Remuxing finished, state updated.")
+    def history(self, seconds):
+        cutoff = time.time() - seconds
+        with self._lock:
+            return [dict(sample) for sample in self._samples if sample["timestamp"] >= cutoff]
+
+system_sampler = SystemSampler()
+system_sampler.start()
+
+def get_cpu_usage():
+    # Get the CPU usage percentage from the latest background sample
+    return system_sampler.latest()["cpu_usage"]
+
+def get_usage_data():
+    return system_sampler.latest()
 
+def display_usage():
+    usage_json = json.dumps(get_usage_data(), indent=4)
+    return usage_json
+
+# Seconds to reuse a disk usage result before calling statvfs again
+DISK_USAGE_TTL = 5
+# Audio bitrate in kbps used by the recording commands
+AUDIO_BITRATE = 96
+
+disk_usage_cache = {"timestamp": 0, "data": None}
+disk_usage_lock = RLock()
+
+def find_mount_point(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+def mount_usage(path, devices):
+    stats = os.statvfs(path)
+    size = stats.f_blocks * stats.f_frsize
+    available = stats.f_bavail * stats.f_frsize
+    used = (stats.f_blocks - stats.f_bfree) * stats.f_frsize
+    # Same percentage df reports (space reserved for root is not counted as usable)
+    use_percentage = round(used / (used + available) * 100) if used + available else 0
+    mounted_on = find_mount_point(path)
+
+    # Bytes per minute of a recording at the configured video + audio bitrate
+    bytes_per_minute = (BITRATE + AUDIO_BITRATE) * 1000 / 8 * 60
+
+    return {
+        "filesystem": devices.get(mounted_on, mounted_on),
+        "size": convert_size(size),
+        "used": convert_size(used),
+        "available": convert_size(available),
+        "use_percentage": f"{use_percentage}%",
+        "mounted_on": mounted_on,
+        "path": os.path.realpath(path),
+        "size_bytes": size,
+        "used_bytes": used,
+        "available_bytes": available,
+        "recording_minutes_remaining": int(available / bytes_per_minute) if bytes_per_minute else None
+    }
+
+def disk_usage():
+    # recordings/ plus DISK_MOUNTS, cached for DISK_USAGE_TTL seconds
+    with disk_usage_lock:
+        if disk_usage_cache["data"] is not None and time.time() - disk_usage_cache["timestamp"] < DISK_USAGE_TTL:
+            return disk_usage_cache["data"]
+
+        try:
+            # /proc/mounts is only read to label each mount point with its device
+            devices = {partition.mountpoint: partition.device for partition in psutil.disk_partitions(all=True)}
+
+            ensure_recordings_directory()
+            usage_data = mount_usage("recordings", devices)
+
+            mounts = []
+            seen = set()
+            extra_mounts = [mount.strip() for mount in current_config.DISK_MOUNTS.split(',') if mount.strip()]
+            for mount in [usage_data["mounted_on"]] + extra_mounts:
+                if not os.path.isdir(mount):
+                    continue
+                mount_point = find_mount_point(mount)
+                if mount_point in seen:
+                    continue
+                seen.add(mount_point)
+                mounts.append(mount_usage(mount_point, devices))
+            usage_data["mounts"] = mounts
+        except Exception as e:
+            usage_data = {'error': str(e)}
+
+        disk_usage_cache["timestamp"] = time.time()
+        disk_usage_cache["data"] = usage_data
+        return usage_data
+
+# Latest ffmpeg -progress snapshot for each pipeline, keyed by pipeline name
+encoder_metrics = {}
+encoder_metrics_lock = RLock()
+# Number of times each pipeline's ffmpeg has been launched
+pipeline_starts = {}
+
+def parse_progress_value(key, value):
+    # "N/A" becomes None
+    value = value.strip()
+    if value == 'N/A' or value == '':
+        return None
+    try:
+        if key in ('frame', 'dup_frames', 'drop_frames', 'total_size', 'out_time_us', 'out_time_ms'):
+            return int(value)
+        if key == 'fps':
+            return float(value)
+        if key == 'bitrate':
+            # e.g. "3950.1kbits/s"
+            return float(value.replace('kbits/s', ''))
+        if key == 'speed':
+            # e.g. "1.01x"
+            return float(value.rstrip('x'))
+    except ValueError:
+        return None
+    return value
+
+def read_progress(name, process, target_fps=None):
+    # Fill encoder_metrics[name] from ffmpeg's -progress pipe:1 blocks
+    block = {}
+    for line in process.stdout:
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            continue
+        block[key] = parse_progress_value(key, value)
+        if key != 'progress':
+            continue
+
+        out_time_us = block.get('out_time_us')
+        metrics = {
+            "pid": process.pid,
+            "running": block.get('progress') == 'continue',
+            "updated_at": time.time(),
+            "frame": block.get('frame'),
+            "fps": block.get('fps'),
+            "target_fps": target_fps,
+            "bitrate_kbps": block.get('bitrate'),
+            "speed": block.get('speed'),
+            "drop_frames": block.get('drop_frames'),
+            "dup_frames": block.get('dup_frames'),
+            "total_size": block.get('total_size'),
+            "out_time": block.get('out_time'),
+            "out_time_seconds": out_time_us / 1000000 if out_time_us is not None else None
+        }
+        with encoder_metrics_lock:
+            metrics["started_at"] = encoder_metrics.get(name, {}).get("started_at")
+            encoder_metrics[name] = metrics
+        block = {}
+
+    with encoder_metrics_lock:
+        if name in encoder_metrics and encoder_metrics[name].get("pid") == process.pid:
+            encoder_metrics[name]["running"] = False
+
+# ffmpeg stderr lines kept per process, to tell why it exited
+FFMPEG_STDERR_TAIL = 50
+# An ffmpeg error about the v4l2 or ALSA input, as opposed to e.g. the RTMP connection dropping
+CAPTURE_INPUT_ERROR = re.compile(r'(video4linux2|v4l2|/dev/video\d+|\[alsa|audio device).*'
+                                 r'(input/output error|no such device|no such file or directory|device or resource busy|cannot open|not a video capture device)',
+                                 re.IGNORECASE)
+
+def read_stderr(process):
+    # Still shown in the service log, as before stderr was captured. ffmpeg blocks once the pipe is full,
+    # so nothing may stop this loop before the pipe closes.
+    try:
+        for line in process.stderr:
+            try:
+                process.stderr_tail.append(line.rstrip())
+                sys.stderr.write(line)
+            except Exception:
+                pass
+    except (OSError, ValueError):
+        pass  # Pipe closed
+
+def capture_input_failed(process):
+    # The last lines may still be in the pipe when the process has just exited
+    process.stderr_thread.join(timeout=2)
+    return any(CAPTURE_INPUT_ERROR.search(line) for line in process.stderr_tail)
+
+def launch_ffmpeg(name, command, target_fps=None, stdin=None):
+    # Progress goes to stdout, parsed by a thread
+    command = [command[0], "-progress", "pipe:1"] + command[1:]
+    process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1,
+                               errors='replace')  # ffmpeg echoes tags in whatever encoding the file has
+    process.stderr_tail = deque(maxlen=FFMPEG_STDERR_TAIL)
+    process.stderr_thread = Thread(target=read_stderr, args=(process,), daemon=True)
+    process.stderr_thread.start()
+
+    with encoder_metrics_lock:
+        encoder_metrics[name] = {"pid": process.pid, "running": True, "started_at": time.time(), "updated_at": None, "target_fps": target_fps}
+        pipeline_starts[name] = pipeline_starts.get(name, 0) + 1
+
+    Thread(target=read_progress, args=(name, process, target_fps), daemon=True).start()
+    return process
+
+# Seconds to wait before restarting a pipeline that exited on its own, doubled after each failed attempt
+RESTART_BACKOFF_INITIAL = 1
+RESTART_BACKOFF_MAX = 60
+# A pipeline that stays up this many seconds resets its backoff
+RESTART_STABLE_AFTER = 30
+
+class FfmpegSupervisor:
+    # Owns one ffmpeg pipeline and restarts it with backoff when it exits on its own
+
+    def __init__(self, name, build_command, target_fps=None, on_give_up=None, uses_capture_device=False, stdin=None):
+        self.name = name
+        self.stdin = stdin
+        self.build_command = build_command
+        self.target_fps = target_fps
+        self.on_give_up = on_give_up
+        self.uses_capture_device = uses_capture_device
+        self.process = None
+        self.started_at = None
+        self.outputs = []
+        self.restarts = 0
+        self.restart_reasons = deque(maxlen=20)
+        self.backoff = RESTART_BACKOFF_INITIAL
+        self._restart_requested = None
+        self._lock = RLock()
+        self._stopping = Event()
+        self._thread = None
+
+    def is_active(self):
+        # Also while waiting to restart
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        # Waits outside the lock so status() stays responsive
+        wait_for_capture_inputs(self.name)
+        with self._lock:
+            if self.is_active():
+                return False
+            self._stopping.clear()
+            self.outputs = []
+            self.backoff = RESTART_BACKOFF_INITIAL
+            self._launch()
+            self._thread = Thread(target=self._watch, name=f"supervisor-{self.name}", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        with self._lock:
+            process = self.process
+            self.process = None
+        if process and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                logging.error(f"{self.name}: ffmpeg did not exit after {timeout}s, killing it")
+                process.kill()
+                process.wait()
+        thread = self._thread
+        if thread and thread is not current_thread():
+            thread.join(timeout=timeout)
+        self._thread = None
+
+    def restart(self, reason):
+        with self._lock:
+            process = self.process
+            if not process:
+                return
+            self._restart_requested = reason
+        process.terminate()
+
+    def status(self):
+        with self._lock:
+            process = self.process
+            return {
+                "active": self.is_active(),
+                "running": bool(process and process.poll() is None),
+                "pid": process.pid if process else None,
+                "started_at": self.started_at,
+                "restarts": self.restarts,
+                "backoff": self.backoff,
+                "restart_reasons": list(self.restart_reasons),
+                "outputs": list(self.outputs)
+            }
+
+    def _launch(self):
+        command, output_file = self.build_command()
+        self.process = launch_ffmpeg(self.name, command, target_fps=self.target_fps, stdin=self.stdin)
+        self.started_at = time.time()
+        if output_file:
+            self.outputs.append(output_file)
+
+    def _watch(self):
+        attempts = 0
+        while not self._stopping.is_set():
+            process = self.process
+            if process is None:
+                break
+            returncode = process.wait()
+            if self._stopping.is_set():
+                break
+
+            uptime = time.time() - self.started_at
+            reason = self._restart_requested
+            self._restart_requested = None
+
+            if reason:
+                # Requested restart, not a failure
+                self.restart_reasons.append({"time": time.time(), "reason": reason, "returncode": returncode})
+                logging.debug(f"{self.name}: restarting ffmpeg ({reason})")
+                delay = 0
+            else:
+                if uptime >= RESTART_STABLE_AFTER:
+                    attempts = 0
+                    self.backoff = RESTART_BACKOFF_INITIAL
+                # Only errors from the camera or microphone count towards a driver reload, not network drops
+                if self.uses_capture_device and capture_input_failed(process):
+                    record_capture_result(False)
+                elif self.uses_capture_device and uptime >= RESTART_STABLE_AFTER:
+                    record_capture_result(True)
+                self.restart_reasons.append({"time": time.time(), "reason": f"ffmpeg exited after {uptime:.1f}s", "returncode": returncode})
+                logging.error(f"{self.name}: ffmpeg exited with code {returncode} after {uptime:.1f}s")
+
+                attempts += 1
+                max_attempts = current_config.RESTART_MAX_ATTEMPTS
+                if max_attempts and attempts > max_attempts:
+                    logging.error(f"{self.name}: giving up after {max_attempts} restarts")
+                    with self._lock:
+                        self.process = None
+                    if self.on_give_up:
+                        Thread(target=self.on_give_up).start()
+                    break
+
+                delay = self.backoff
+                self.backoff = min(self.backoff * 2, RESTART_BACKOFF_MAX)
+                logging.debug(f"{self.name}: restarting in {delay}s")
+
+            if self._stopping.wait(delay):
+                break
+            wait_for_capture_inputs(self.name)
+            if self.uses_capture_device and not reason:
+                prepare_capture_device()
+
+            with self._lock:
+                if self._stopping.is_set():
+                    break
+                try:
+                    self._launch()
+                    self.restarts += 1
+                except Exception as e:
+                    logging.error(f"{self.name}: failed to restart ffmpeg: {e}")
+                    self.process = None
+                    if self.on_give_up:
+                        Thread(target=self.on_give_up).start()
+                    break
 
 # Initialize variables
 streaming = False
@@ -377,38 +1045,371 @@ recording = False
 file_streaming = False
 stream_recording = False
 
-# Initialize global variables
-stream_record_process = None
-stream_recording = False
-stream_process = None
-streaming = False
-file_stream_process = None
-file_streaming = False
-
 state_file = 'state.json'
 
 default_state = {"streaming": False, "recording": False, "file_streaming": False, "streaming_and_recording": False, "remux": False, "start_time": None}
 
-# Sets the default state on startup
-def load_default_state():    
-    with open("state.json", "w") as file:
-        json.dump(default_state, file, indent=4)
+class StateManager:
+    # Stream state kept in memory; state.json is only rewritten when a value changes
+
+    def __init__(self, path, defaults, flush_delay=0):
+        self.path = path
+        self.flush_delay = flush_delay
+        self._lock = RLock()
+        self._changed = Condition(self._lock)
+        self._state = dict(defaults)
+        self._flush_timer = None
+        self.version = 0
+
+    def get(self):
+        with self._lock:
+            return dict(self._state)
+
+    def update(self, **changes):
+        with self._lock:
+            changed = {key: value for key, value in changes.items() if self._state.get(key) != value}
+            if changed:
+                self._state.update(changed)
+                self.version += 1
+                self._changed.notify_all()
+                self._schedule_write()
+            return dict(self._state)
+
+    def wait_for_change(self, version, timeout=None):
+        with self._lock:
+            if self.version == version:
+                self._changed.wait(timeout)
+            return self.version, dict(self._state)
+
+    def replace(self, state):
+        with self._lock:
+            return self.update(**state)
+
+    def flush(self):
+        with self._lock:
+            if self._flush_timer:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._write()
+
+    def _schedule_write(self):
+        if self.flush_delay <= 0:
+            self._write()
+        elif self._flush_timer is None:
+            self._flush_timer = Timer(self.flush_delay, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _write(self):
+        tmp_file = f"{self.path}.tmp"
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self._state, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.path)
+        except OSError as e:
+            logging.error(f"Failed to write {self.path}: {e}")
 
-# Sets default state
-load_default_state()
+# Sets the default state on startup
+state_manager = StateManager(state_file, default_state, current_config.STATE_FLUSH_DELAY)
+state_manager.flush()
 
-# Save current state to json file
 def load_state():
-    if os.path.exists(state_file):
-        with open(state_file, 'r') as f:
-            return json.load(f)
-    return default_state
+    return state_manager.get()
 
 def save_state(state):
-    with open(state_file, 'w') as f:
-        json.dump(state, f)
-
-state = load_state()
+    return state_manager.replace(state)
+
+def update_state(**changes):
+    return state_manager.update(**changes)
+
+# Background ffmpeg jobs (remuxing stopped recordings, joining segments), kept in jobs.json so they survive a restart
+JOBS_FILE = 'jobs.json'
+# Finished jobs to keep in the list
+JOB_HISTORY = 50
+
+def job_temp_file(output_file):
+    # Where a job writes before its result replaces output_file
+    return output_file.replace('.mp4', '_remuxed.mp4')
+
+def low_priority_command(command):
+    # nice and ionice prefixes, so jobs yield CPU and disk I/O to the live pipelines
+    # Not preexec_fn: forking with a callback is unsafe while other threads hold locks
+    config = current_config
+    if shutil.which('ionice'):
+        level = ["-n", str(config.JOB_IONICE_LEVEL)] if config.JOB_IONICE_CLASS in (1, 2) else []
+        command = ["ionice", "-c", str(config.JOB_IONICE_CLASS)] + level + command
+    if shutil.which('nice'):
+        command = ["nice", "-n", str(config.JOB_NICE)] + command
+    return command
+
+def run_job_ffmpeg(job, command, total_bytes):
+    # Progress is estimated from the bytes written
+    command = low_priority_command(command)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    for line in process.stdout:
+        key, _, value = line.strip().partition('=')
+        if key == 'total_size' and total_bytes:
+            size = parse_progress_value(key, value)
+            if size is not None:
+                job["progress"] = round(min(size / total_bytes, 1.0), 3)
+    returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+
+def run_remux_job(job):
+    # The original is only replaced once the copy succeeded
+    input_file = job["inputs"][0]
+    temp_file = job_temp_file(input_file)
+    remux_command = [
+        "ffmpeg",
+        "-y",  # Overwrite output file without prompt
+        "-i", input_file,  # Input file
+        "-c", "copy",  # Copy both audio and video streams
+        "-f", "mp4",  # Output format
+        "-nostats",  # Disable statistics display
+        "-progress", "pipe:1",
+        "-threads", str(current_config.JOB_THREADS),
+        temp_file  # Output file
+    ]
+    try:
+        run_job_ffmpeg(job, remux_command, os.path.getsize(input_file))
+        os.replace(temp_file, input_file)
+    except Exception:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    logging.debug(f"Successfully remuxed and replaced: {input_file}")
+
+def run_concat_job(job):
+    # Stream copy, the originals are kept
+    output_file = job["output"]
+    temp_file = job_temp_file(output_file)
+    list_file = f"{output_file}.txt"
+    try:
+        with open(list_file, 'w') as file:
+            for recording_file in job["inputs"]:
+                file.write(f"file '{os.path.abspath(recording_file)}'\n")
+        concat_command = [
+            "ffmpeg",
+            "-y",
+            "-f", "concat", "-safe", "0", "-i", list_file,
+            "-c", "copy",
+            "-movflags", "+faststart",
+            "-f", "mp4",
+            "-nostats",
+            "-progress", "pipe:1",
+            "-threads", str(current_config.JOB_THREADS),
+            temp_file
+        ]
+        run_job_ffmpeg(job, concat_command, sum(os.path.getsize(path) for path in job["inputs"]))
+        os.replace(temp_file, output_file)
+    except Exception:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    finally:
+        if os.path.exists(list_file):
+            os.remove(list_file)
+    logging.debug(f"Joined {len(job['inputs'])} recordings into {output_file}")
+
+# Media library files are re-encoded once to one stream-compatible format so file streaming can copy them.
+# The originals are left alone; the results are cached under media/.cache by content hash.
+MEDIA_DIR = 'media'
+MEDIA_CACHE_DIR = os.path.join(MEDIA_DIR, '.cache')
+MEDIA_CACHE_NAME = re.compile(r'[0-9a-f]{64}\.mp4')
+MEDIA_EXTENSIONS = ('.avi', '.mkv', '.mp4', '.m4v', '.mov', '.ts', '.vid')  # As convert.sh
+# Keyframe every 2 seconds, as RTMP ingests expect
+MEDIA_KEYFRAME_SECONDS = 2
+MEDIA_AUDIO_SAMPLE_RATE = 44100
+MEDIA_AUDIO_CHANNELS = 2
+# Bumped when media_incompatibility checks more, so existing index entries are checked again
+MEDIA_INDEX_VERSION = 2
+
+def media_profile(config=None):
+    # Part of the cache key, so changing it normalizes again
+    config = config or current_config
+    return f"h264/yuv420p/{config.MEDIA_VIDEO_SIZE}/{config.MEDIA_FRAME_RATE}/aac-{MEDIA_AUDIO_SAMPLE_RATE}-{MEDIA_AUDIO_CHANNELS}"
+
+def run_normalize_job(job):
+    # The original is not touched
+    input_file = job["inputs"][0]
+    output_file = job["output"]
+    temp_file = job_temp_file(output_file)
+    width, height = current_config.MEDIA_VIDEO_SIZE.split('x')
+    frame_rate = current_config.MEDIA_FRAME_RATE
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    normalize_command = [
+        "ffmpeg",
+        "-y",
+        "-i", input_file,
+        "-map", "0:v:0", "-map", "0:a:0?",
+        # Fit inside the target size and pad, so every file has the same resolution
+        "-vf", f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={frame_rate}",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "23", "-pix_fmt", "yuv420p",  # As convert.sh
+        "-g", str(frame_rate * MEDIA_KEYFRAME_SECONDS), "-keyint_min", str(frame_rate * MEDIA_KEYFRAME_SECONDS), "-sc_threshold", "0",
+        "-c:a", "aac", "-b:a", "96k", "-ar", str(MEDIA_AUDIO_SAMPLE_RATE), "-ac", str(MEDIA_AUDIO_CHANNELS),
+        "-movflags", "+faststart",
+        "-f", "mp4",
+        "-nostats",
+        "-progress", "pipe:1",
+        "-threads", str(current_config.JOB_THREADS),
+        temp_file
+    ]
+    try:
+        run_job_ffmpeg(job, normalize_command, os.path.getsize(input_file))
+        os.replace(temp_file, output_file)
+    except Exception:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    logging.debug(f"Normalized {input_file} to {output_file}")
+
+JOB_RUNNERS = {"remux": run_remux_job, "concat": run_concat_job, "normalize": run_normalize_job}
+# Run on one worker of their own next to the JOB_WORKERS workers. Media normalization can take hours
+# and must not hold up finishing a recording.
+JOB_BACKGROUND_KINDS = ("normalize",)
+JOB_BACKGROUND_WORKER = "background"
+
+class JobQueue:
+    # Persistent queue of ffmpeg jobs; the state's remux flag is set while remux jobs are pending
+
+    def __init__(self, path, workers=1):
+        self.path = path
+        self.jobs = []
+        self._condition = Condition(RLock())
+        self._workers = {}
+        self._load()
+        self.set_workers(workers)
+
+    def set_workers(self, workers):
+        with self._condition:
+            self.workers = max(workers, 1)
+            for number in [JOB_BACKGROUND_WORKER, *range(self.workers)]:
+                if number not in self._workers:
+                    self._workers[number] = Thread(target=self._work, args=(number,), name=f"job-worker-{number}", daemon=True)
+                    self._workers[number].start()
+            # Extra workers exit once they are idle
+            self._condition.notify_all()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as file:
+                self.jobs = json.load(file)
+        except (OSError, ValueError):
+            self.jobs = []
+
+        for job in self.jobs:
+            if job["status"] != "running":
+                continue
+            # Interrupted by a restart: keep a finished copy whose original is gone, otherwise start over
+            temp_file = job_temp_file(job["output"])
+            if job["kind"] == "remux" and not os.path.exists(job["output"]) and os.path.exists(temp_file):
+                os.replace(temp_file, job["output"])
+                job.update(status="done", progress=1.0, finished=time.time())
+                continue
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            job.update(status="queued", progress=0.0, started=None)
+            logging.debug(f"Requeued interrupted job {job['id']} ({job['kind']} {job['output']})")
+
+        # Half-finished remuxes from before jobs were tracked
+        known = {job["output"] for job in self.jobs}
+        for temp_file in glob.glob(os.path.join('recordings', '*_remuxed.mp4')):
+            original = temp_file.replace('_remuxed.mp4', '.mp4')
+            if original in known:
+                continue
+            if os.path.exists(original):
+                os.remove(temp_file)
+                self._append("remux", [original], original)
+            else:
+                os.replace(temp_file, original)
+            logging.debug(f"Recovered interrupted remux of {original}")
+
+        self._save()
+
+    def _append(self, kind, inputs, output):
+        job = {
+            "id": f"{int(time.time() * 1000)}-{len(self.jobs)}",
+            "kind": kind,
+            "inputs": list(inputs),
+            "output": output,
+            "status": "queued",
+            "progress": 0.0,
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "error": None
+        }
+        self.jobs.append(job)
+        return job
+
+    def submit(self, kind, inputs, output):
+        with self._condition:
+            job = self._append(kind, inputs, output)
+            self._save()
+            # Wake every worker, only the ones for this kind of job will take it
+            self._condition.notify_all()
+        logging.debug(f"Queued {kind} job {job['id']} for {output}")
+        return job
+
+    def list(self):
+        with self._condition:
+            return [dict(job) for job in self.jobs]
+
+    def pending(self, kind=None):
+        with self._condition:
+            return any(job["status"] in ("queued", "running") and (kind is None or job["kind"] == kind) for job in self.jobs)
+
+    def _save(self):
+        with self._condition:
+            # Drop the oldest finished jobs
+            finished = [job for job in self.jobs if job["status"] in ("done", "failed")]
+            for job in finished[:max(len(finished) - JOB_HISTORY, 0)]:
+                self.jobs.remove(job)
+            data = json.dumps(self.jobs, indent=4)
+        tmp_file = f"{self.path}.tmp"
+        try:
+            with open(tmp_file, 'w') as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_file, self.path)
+        except OSError as e:
+            logging.error(f"Failed to write {self.path}: {e}")
+
+    def _work(self, number):
+        while True:
+            with self._condition:
+                background = number == JOB_BACKGROUND_WORKER
+                if not background and number >= self.workers:
+                    del self._workers[number]
+                    return
+                job = next((job for job in self.jobs if job["status"] == "queued" and (job["kind"] in JOB_BACKGROUND_KINDS) == background), None)
+                if job is None:
+                    self._condition.wait()
+                    continue
+                job.update(status="running", started=time.time())
+                self._save()
+
+            logging.debug(f"Running {job['kind']} job {job['id']} for {job['output']}")
+            try:
+                JOB_RUNNERS[job["kind"]](job)
+                job.update(status="done", progress=1.0)
+            except Exception as e:
+                logging.error(f"{job['kind']} job {job['id']} for {job['output']} failed: {e}")
+                job.update(status="failed", error=str(e))
+
+            with self._condition:
+                job["finished"] = time.time()
+                self._save()
+            if job["kind"] == "remux" and not self.pending("remux"):
+                update_state(remux=False)
+                logging.debug("Remuxing finished, state updated.")
+
+job_queue = JobQueue(JOBS_FILE, current_config.JOB_WORKERS)
+update_state(remux=job_queue.pending("remux"))
 
 def ensure_recordings_directory():
     if not os.path.exists("recordings"):
@@ -420,9 +1421,84 @@ def reinitialize_device():
         subprocess.run(["sudo", "modprobe", "-r", "uvcvideo"], check=True)
         subprocess.run(["sudo", "modprobe", "uvcvideo"], check=True)
         logging.debug("uvcvideo module reloaded.")
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, OSError) as e:
         logging.error(f"Failed to reload uvcvideo module: {e}")
 
+# VIDIOC_QUERYCAP is _IOR('V', 0, struct v4l2_capability), a 104 byte struct
+VIDIOC_QUERYCAP = 0x80685600
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+# Seconds to wait for the device node to come back after a reload
+DEVICE_RELOAD_SETTLE = 5
+
+capture_device_stats = {"checks": 0, "reloads": 0, "consecutive_failures": 0, "last_check_seconds": None, "last_reload_seconds": None, "last_reload_reason": None}
+capture_device_lock = RLock()
+
+def check_capture_device(device=VIDEO_DEVICE):
+    # None if VIDIOC_QUERYCAP reports video capture, otherwise what is wrong
+    try:
+        fd = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+    except OSError as e:
+        return f"cannot open {device}: {e.strerror}"
+    try:
+        capability = bytearray(104)
+        fcntl.ioctl(fd, VIDIOC_QUERYCAP, capability)
+    except OSError as e:
+        return f"VIDIOC_QUERYCAP failed on {device}: {e.strerror}"
+    finally:
+        os.close(fd)
+    # driver[16], card[32], bus_info[32], version, then capabilities and device_caps
+    capabilities, device_caps = struct.unpack_from('=II', capability, 84)
+    if capabilities & V4L2_CAP_DEVICE_CAPS:
+        capabilities = device_caps
+    if not capabilities & V4L2_CAP_VIDEO_CAPTURE:
+        return f"{device} is not a video capture device"
+    return None
+
+def reload_capture_device(reason):
+    with capture_device_lock:
+        started = time.time()
+        reinitialize_device()
+        # udev recreates the device node asynchronously
+        while not os.path.exists(VIDEO_DEVICE) and time.time() - started < DEVICE_RELOAD_SETTLE:
+            time.sleep(0.1)
+        capture_device_stats["reloads"] += 1
+        capture_device_stats["consecutive_failures"] = 0
+        capture_device_stats["last_reload_seconds"] = round(time.time() - started, 3)
+        capture_device_stats["last_reload_reason"] = reason
+        logging.debug(f"Reloaded uvcvideo ({reason}) in {capture_device_stats['last_reload_seconds']:.2f}s")
+
+def prepare_capture_device():
+    # Reload uvcvideo only when the health check fails or captures keep failing
+    with capture_device_lock:
+        started = time.time()
+        problem = check_capture_device()
+        capture_device_stats["checks"] += 1
+        capture_device_stats["last_check_seconds"] = round(time.time() - started, 6)
+        failures = capture_device_stats["consecutive_failures"]
+        if problem is None and failures < current_config.DEVICE_RELOAD_AFTER_FAILURES:
+            logging.debug(f"Capture device healthy, check took {capture_device_stats['last_check_seconds'] * 1000:.1f}ms")
+            return
+        reload_capture_device(problem or f"{failures} capture failures in a row")
+
+def record_capture_result(ok):
+    with capture_device_lock:
+        capture_device_stats["consecutive_failures"] = 0 if ok else capture_device_stats["consecutive_failures"] + 1
+
+# Cleared while the capture device driver is being reloaded, so pipelines do not start on a vanishing device
+capture_device_ready = Event()
+capture_device_ready.set()
+# Seconds a pipeline start waits for a device reload to finish
+DEVICE_RELOAD_TIMEOUT = 30
+
+def wait_for_capture_inputs(name):
+    # Wait for hardware discovery and any capture device reload
+    # Commands depend on the audio device, capture modes and encoder found by discovery
+    if not discovery_complete.wait(DISCOVERY_TIMEOUT):
+        logging.error(f"{name}: hardware discovery has not finished, starting with defaults")
+    if not capture_device_ready.wait(DEVICE_RELOAD_TIMEOUT):
+        logging.error(f"{name}: capture device reload has not finished, starting anyway")
+
 def convert_size(size_bytes):
     if size_bytes == 0:
         return '0 B'
@@ -433,41 +1509,397 @@ def convert_size(size_bytes):
         i += 1
     return f'{size_bytes:.2f} {size_name[i]}'
 
-def list_recordings():
-    ensure_recordings_directory()
-
-    recordings_dir = "recordings"
-    
+# Recording metadata catalog, so the Recordings tab does not stat and sort every file on each page load
+RECORDINGS_DIR = "recordings"
+RECORDINGS_DB = 'recordings.db'
+# Recordings per page on the Recordings tab and the default for /api/recordings
+RECORDINGS_PAGE_SIZE = 50
+# Seconds a file must be unchanged before ffprobe reads it (files being recorded keep changing)
+CATALOG_PROBE_SETTLE = 30
+# Seconds between checks for files that still need probing
+CATALOG_PROBE_INTERVAL = 10
+RECORDING_SORT_COLUMNS = {"modified": "mtime", "size": "size", "filename": "filename", "duration": "duration"}
+
+def parse_ffprobe(output):
+    # Fields of ffprobe -show_format -show_streams JSON
+    data = json.loads(output or '{}')
+    info = {"duration": None, "video_codec": None, "audio_codec": None, "width": None, "height": None, "bitrate": None,
+            "pix_fmt": None, "frame_rate": None, "audio_sample_rate": None, "audio_channels": None}
+    format_info = data.get("format", {})
+    for key, source in (("duration", "duration"), ("bitrate", "bit_rate")):
+        try:
+            info[key] = float(format_info[source]) if key == "duration" else int(format_info[source])
+        except (KeyError, ValueError, TypeError):
+            pass
+    for stream in data.get("streams", []):
+        if stream.get("codec_type") == "video" and not info["video_codec"]:
+            info.update(video_codec=stream.get("codec_name"), width=stream.get("width"), height=stream.get("height"), pix_fmt=stream.get("pix_fmt"))
+            numerator, _, denominator = str(stream.get("avg_frame_rate") or "").partition('/')
+            try:
+                info["frame_rate"] = round(float(numerator) / float(denominator or 1), 3)
+            except (ValueError, ZeroDivisionError):
+                pass
+        elif stream.get("codec_type") == "audio" and not info["audio_codec"]:
+            info.update(audio_codec=stream.get("codec_name"), audio_channels=stream.get("channels"))
+            try:
+                info["audio_sample_rate"] = int(stream["sample_rate"])
+            except (KeyError, ValueError, TypeError):
+                pass
+    return info
+
+def probe_recording(file_path):
     try:
-        # Get all files in the directory
-        files = []
-        for filename in os.listdir(recordings_dir):
-            if not filename == ".gitkeep":
-                file_path = os.path.join(recordings_dir, filename)
-                # Get file details
-                file_stats = os.stat(file_path)
-                modification_date = file_stats.st_mtime  # Modification time as timestamp
-                size = file_stats.st_size                # Size in bytes
-                
-                # Convert modification date to readable format
-                modification_date_str = datetime.utcfromtimestamp(modification_date).strftime("%Y-%m-%d %H:%M:%S")
-
-                # Convert size to human-readable format
-                size_str = convert_size(size)
-                
-                files.append({
-                    'filename': filename,
-                    'size': size_str,
-                    'modified': modification_date_str,
-                    'timestamp': modification_date
-                })
-        
-        files.sort(key=lambda x: x['timestamp'], reverse=True)
-        
-        return files
+        output = subprocess.run(["ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", file_path],
+                                capture_output=True, text=True, timeout=30).stdout
+        return parse_ffprobe(output)
+    except (OSError, subprocess.TimeoutExpired, ValueError) as e:
+        logging.error(f"ffprobe failed for {file_path}: {e}")
+        return parse_ffprobe(None)
+
+class RecordingCatalog:
+    # SQLite index of recordings/, rescanned when the directory mtime changes
+
+    def __init__(self, path, directory):
+        self.directory = directory
+        self._lock = RLock()
+        self._directory_mtime = None
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS recordings (
+                filename TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                duration REAL,
+                video_codec TEXT,
+                audio_codec TEXT,
+                width INTEGER,
+                height INTEGER,
+                bitrate INTEGER,
+                thumbnail TEXT,
+                probed INTEGER NOT NULL DEFAULT 0
+            )""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS recordings_mtime ON recordings (mtime)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS recordings_size ON recordings (size)")
+        self._probe_wanted = Event()
+        Thread(target=self._probe_loop, name="recording-catalog", daemon=True).start()
+
+    def sync(self, force=False):
+        ensure_recordings_directory()
+        directory_mtime = os.stat(self.directory).st_mtime_ns
+        with self._lock:
+            if not force and directory_mtime == self._directory_mtime:
+                return
+            self._directory_mtime = directory_mtime
+            files = {}
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name != ".gitkeep" and entry.is_file():
+                        stat = entry.stat()
+                        files[entry.name] = (stat.st_size, stat.st_mtime)
+            known = {row["filename"]: (row["size"], row["mtime"]) for row in self._db.execute("SELECT filename, size, mtime FROM recordings")}
+            with self._db:
+                removed = [(filename,) for filename in known if filename not in files]
+                self._db.executemany("DELETE FROM recordings WHERE filename = ?", removed)
+                changed = [(filename, size, mtime) for filename, (size, mtime) in files.items() if known.get(filename) != (size, mtime)]
+                self._db.executemany("""INSERT INTO recordings (filename, size, mtime) VALUES (?, ?, ?)
+                    ON CONFLICT(filename) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, probed = 0, thumbnail = NULL""", changed)
+        for (filename,) in removed:
+            remove_thumbnails(filename)
+        if changed or removed:
+            logging.debug(f"Recording catalog: {len(changed)} added/changed, {len(removed)} removed")
+            self._probe_wanted.set()
+
+    def invalidate(self):
+        # e.g. after a recording stopped, its final size is written without a directory change
+        with self._lock:
+            self._directory_mtime = None
+
+    def refresh(self, filename):
+        # e.g. once a recording has been finalized
+        file_path = os.path.join(self.directory, filename)
+        with self._lock, self._db:
+            if not os.path.isfile(file_path):
+                self._db.execute("DELETE FROM recordings WHERE filename = ?", (filename,))
+                remove_thumbnails(filename)
+                return
+            stat = os.stat(file_path)
+            self._db.execute("""INSERT INTO recordings (filename, size, mtime) VALUES (?, ?, ?)
+                ON CONFLICT(filename) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, probed = 0, thumbnail = NULL""",
+                             (filename, stat.st_size, stat.st_mtime))
+        self._probe_wanted.set()
+
+    def needing_thumbnails(self, limit=10):
+        # Newest first
+        with self._lock:
+            return [dict(row) for row in self._db.execute("""SELECT filename, size, mtime, duration FROM recordings
+                WHERE probed = 1 AND thumbnail IS NULL AND video_codec IS NOT NULL ORDER BY mtime DESC LIMIT ?""", (limit,))]
+
+    def set_thumbnail(self, filename, thumbnail):
+        with self._lock, self._db:
+            self._db.execute("UPDATE recordings SET thumbnail = ? WHERE filename = ?", (thumbnail, filename))
+
+    def page(self, page=1, per_page=RECORDINGS_PAGE_SIZE, sort="modified", order="desc"):
+        # (total, rows), newest first by default
+        self.sync()
+        column = RECORDING_SORT_COLUMNS.get(sort, "mtime")
+        direction = "ASC" if order == "asc" else "DESC"
+        per_page = max(1, min(int(per_page), 500))
+        page = max(1, int(page))
+        with self._lock:
+            total = self._db.execute("SELECT COUNT(*) FROM recordings").fetchone()[0]
+            rows = self._db.execute(f"SELECT * FROM recordings ORDER BY {column} {direction}, filename LIMIT ? OFFSET ?",
+                                    (per_page, (page - 1) * per_page)).fetchall()
+        return total, [recording_row(row) for row in rows]
+
+    def _probe_loop(self):
+        while True:
+            self._probe_wanted.wait(CATALOG_PROBE_INTERVAL)
+            self._probe_wanted.clear()
+            with self._lock:
+                pending = self._db.execute("SELECT filename, size, mtime FROM recordings WHERE probed = 0 AND mtime < ? ORDER BY mtime DESC",
+                                           (time.time() - CATALOG_PROBE_SETTLE,)).fetchall()
+            for row in pending:
+                info = probe_recording(os.path.join(self.directory, row["filename"]))
+                with self._lock, self._db:
+                    # Only store the result if the file did not change while it was probed
+                    self._db.execute("""UPDATE recordings SET duration = :duration, video_codec = :video_codec, audio_codec = :audio_codec,
+                        width = :width, height = :height, bitrate = :bitrate, probed = 1
+                        WHERE filename = :filename AND size = :size AND mtime = :mtime""",
+                                     dict(info, filename=row["filename"], size=row["size"], mtime=row["mtime"]))
+
+def recording_row(row):
+    return {
+        'filename': row["filename"],
+        'size': convert_size(row["size"]),
+        'size_bytes': row["size"],
+        'modified': datetime.utcfromtimestamp(row["mtime"]).strftime("%Y-%m-%d %H:%M:%S"),
+        'timestamp': row["mtime"],
+        'duration': row["duration"],
+        'video_codec': row["video_codec"],
+        'audio_codec': row["audio_codec"],
+        'resolution': f"{row['width']}x{row['height']}" if row["width"] and row["height"] else None,
+        'bitrate': row["bitrate"],
+        'thumbnail': f"/thumbnails/{row['thumbnail']}" if row["thumbnail"] else None,
+        'sprite': f"/thumbnails/{sprite_name(row['filename'])}" if row["thumbnail"] else None
+    }
+
+# Poster frames and seek-preview sprites, generated in the background for finished recordings
+THUMBNAIL_DIR = 'thumbnails'
+THUMBNAIL_WIDTH = 320
+# The sprite is SPRITE_FRAMES frames, SPRITE_FRAME_WIDTH pixels wide each, in one row
+SPRITE_FRAMES = 10
+SPRITE_FRAME_WIDTH = 160
+# Seconds between checks for recordings that need thumbnails
+THUMBNAIL_INTERVAL = 15
+
+def thumbnail_name(filename):
+    return f"{filename}.jpg"
+
+def sprite_name(filename):
+    return f"{filename}.sprite.jpg"
+
+def remove_thumbnails(filename):
+    for name in (thumbnail_name(filename), sprite_name(filename)):
+        path = os.path.join(THUMBNAIL_DIR, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+def thumbnail_headroom():
+    # Thumbnails must not compete with a live pipeline
+    if not any(supervisor.is_active() for supervisor in all_supervisors()):
+        return True
+    cpu_usage = system_sampler.latest().get("cpu_usage")
+    return cpu_usage is not None and cpu_usage < current_config.THUMBNAIL_MAX_CPU
+
+def make_thumbnails(filename, duration):
+    # Poster frame and seek-preview sprite
+    os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+    file_path = os.path.join(RECORDINGS_DIR, filename)
+    duration = duration or 0
+    poster_command = [
+        "ffmpeg", "-y", "-nostats", "-loglevel", "error",
+        "-ss", f"{min(duration * 0.1, 5):.2f}",  # Skip a black first frame
+        "-i", file_path,
+        "-frames:v", "1", "-vf", f"scale={THUMBNAIL_WIDTH}:-2",
+        os.path.join(THUMBNAIL_DIR, thumbnail_name(filename))
+    ]
+    sprite_command = [
+        "ffmpeg", "-y", "-nostats", "-loglevel", "error",
+        "-skip_frame", "nokey",  # Only decode keyframes, much cheaper than decoding every frame
+        "-i", file_path,
+        "-vf", f"fps={SPRITE_FRAMES}/{max(duration, 1):.2f},scale={SPRITE_FRAME_WIDTH}:-2,tile={SPRITE_FRAMES}x1",
+        "-frames:v", "1",
+        os.path.join(THUMBNAIL_DIR, sprite_name(filename))
+    ]
+    for command in (poster_command, sprite_command):
+        subprocess.run(low_priority_command(command), check=True, timeout=300, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
+def thumbnail_worker():
+    while True:
+        time.sleep(THUMBNAIL_INTERVAL)
+        try:
+            for row in recording_catalog.needing_thumbnails():
+                if not thumbnail_headroom():
+                    break
+                try:
+                    make_thumbnails(row["filename"], row["duration"])
+                    recording_catalog.set_thumbnail(row["filename"], thumbnail_name(row["filename"]))
+                    logging.debug(f"Made thumbnails for {row['filename']}")
+                except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                    logging.error(f"Making thumbnails for {row['filename']} failed: {e}")
+                    remove_thumbnails(row["filename"])
+                    # Empty marks it as tried, so a broken file is not retried until it changes
+                    recording_catalog.set_thumbnail(row["filename"], '')
+        except Exception as e:
+            logging.error(f"Thumbnail worker error: {e}")
+
+recording_catalog = RecordingCatalog(RECORDINGS_DB, RECORDINGS_DIR)
+Thread(target=thumbnail_worker, name="thumbnails", daemon=True).start()
+
+def media_file_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def media_incompatibility(info):
+    # Why a file cannot be stream-copied next to the normalized files, or None
+    width, height = (int(value) for value in current_config.MEDIA_VIDEO_SIZE.split('x'))
+    if info["video_codec"] != "h264":
+        return f"video codec {info['video_codec'] or 'missing'}"
+    if info["pix_fmt"] not in ("yuv420p", "yuvj420p"):
+        return f"pixel format {info['pix_fmt']}"
+    if (info["width"], info["height"]) != (width, height):
+        return f"resolution {info['width']}x{info['height']}"
+    if not info["frame_rate"] or abs(info["frame_rate"] - current_config.MEDIA_FRAME_RATE) > 0.1:
+        return f"frame rate {info['frame_rate']}"
+    if info["audio_codec"] not in (None, "aac"):
+        return f"audio codec {info['audio_codec']}"
+    # The output ffmpeg copies the audio, so a different rate or layout breaks at the file boundary
+    if info["audio_codec"] and info["audio_sample_rate"] != MEDIA_AUDIO_SAMPLE_RATE:
+        return f"audio sample rate {info['audio_sample_rate']}"
+    if info["audio_codec"] and info["audio_channels"] != MEDIA_AUDIO_CHANNELS:
+        return f"audio channels {info['audio_channels']}"
+    return None
+
+class MediaLibrary:
+    # Normalizes incompatible media files once, cached by content hash
+
+    def __init__(self, directory, cache_dir):
+        self.directory = directory
+        self.cache_dir = cache_dir
+        self.index_file = os.path.join(cache_dir, 'index.json')
+        self._lock = RLock()
+        self._scan_lock = RLock()
+        try:
+            with open(self.index_file, 'r') as file:
+                self.files = json.load(file)
+        except (OSError, ValueError):
+            self.files = {}
+
+    def _save(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with self._lock:
+            data = json.dumps(self.files, indent=4)
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, 'w') as file:
+            file.write(data)
+        os.replace(tmp_file, self.index_file)
+
+    def cache_file(self, entry):
+        return os.path.join(self.cache_dir, f"{entry['hash']}.mp4")
+
+    def _entry(self, file_path):
+        stat = os.stat(file_path)
+        with self._lock:
+            entry = self.files.get(file_path)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime and entry["profile"] == media_profile() \
+                and entry.get("version") == MEDIA_INDEX_VERSION:
+            return entry
+        info = probe_recording(file_path)
+        content_hash = media_file_hash(file_path)
+        entry = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "profile": media_profile(),
+            "version": MEDIA_INDEX_VERSION,
+            "hash": hashlib.sha256(f"{content_hash}/{media_profile()}".encode()).hexdigest(),
+            "duration": info["duration"],
+            "reason": media_incompatibility(info)
+        }
+        with self._lock:
+            self.files[file_path] = entry
+        return entry
+
+    def scan(self):
+        if not self._scan_lock.acquire(blocking=False):
+            return  # Already scanning
+        try:
+            self._scan()
+        finally:
+            self._scan_lock.release()
+
+    def _scan(self):
+        paths = sorted(os.path.abspath(path) for path in glob.glob(os.path.join(self.directory, '*'))
+                       if path.lower().endswith(MEDIA_EXTENSIONS) and os.path.isfile(path))
+        pending = {job["output"] for job in job_queue.list() if job["kind"] == "normalize" and job["status"] in ("queued", "running")}
+        for path in paths:
+            try:
+                entry = self._entry(path)
+            except OSError as e:
+                logging.error(f"Media library: cannot read {path}: {e}")
+                continue
+            cache_file = self.cache_file(entry)
+            if entry["reason"] and not os.path.exists(cache_file) and cache_file not in pending:
+                logging.debug(f"Media library: normalizing {path} ({entry['reason']})")
+                job_queue.submit("normalize", [path], cache_file)
+                pending.add(cache_file)
+
+        with self._lock:
+            self.files = {path: entry for path, entry in self.files.items() if path in paths}
+            wanted = {self.cache_file(entry) for entry in self.files.values() if entry["reason"]}
+        for cache_file in glob.glob(os.path.join(self.cache_dir, '*.mp4')):
+            # Only finished results; a running normalize job writes <hash>_remuxed.mp4 next to them
+            if not MEDIA_CACHE_NAME.fullmatch(os.path.basename(cache_file)):
+                continue
+            if cache_file not in wanted and cache_file not in pending:
+                os.remove(cache_file)
+                logging.debug(f"Media library: removed unused {cache_file}")
+        self._save()
+
+    def resolve(self, file_path):
+        # The normalized copy once it is ready
+        with self._lock:
+            entry = self.files.get(os.path.abspath(file_path))
+        if not entry or not entry["reason"]:
+            return file_path
+        cache_file = self.cache_file(entry)
+        if os.path.exists(cache_file):
+            return cache_file
+        logging.debug(f"Media library: {file_path} is not normalized yet ({entry['reason']}), streaming the original")
+        return file_path
+
+    def status(self):
+        with self._lock:
+            files = dict(self.files)
+        return [{
+            "path": path,
+            "compatible": not entry["reason"],
+            "reason": entry["reason"],
+            "normalized": bool(entry["reason"]) and os.path.exists(self.cache_file(entry)),
+            "duration": entry["duration"]
+        } for path, entry in sorted(files.items())]
+
+media_library = MediaLibrary(MEDIA_DIR, MEDIA_CACHE_DIR)
+
+def list_recordings(page=1, per_page=RECORDINGS_PAGE_SIZE, sort="modified", order="desc"):
+    try:
+        return recording_catalog.page(page, per_page, sort, order)
     except Exception as e:
         logging.debug(f"Error accessing directory: {e}")
+        return 0, []
 
 def delete_file(directory, filename):
     try:
@@ -516,53 +1948,1070 @@ def start_max_timer():
         except ValueError:
             logging.error(f"Invalid MAX_TIME format: {MAX_TIME}. Expected HH:MM:SS or HH:MM")
 
-def start_stream():
-    global stream_process, streaming
+# Hardware MJPEG decoders to use when ffmpeg provides one
+HW_MJPEG_DECODERS = ("mjpeg_v4l2m2m",)
+
+# H.264 profile_idc values, used by encoders without named profile options
+H264_PROFILE_IDS = {"baseline": 66, "main": 77, "high": 100}
+
+def parse_ffmpeg_codecs(output):
+    # Codec names from ffmpeg -encoders or -decoders
+    encoders = set()
+    for line in output.splitlines():
+        # e.g. " V....D libx264              libx264 H.264 / AVC ..."
+        match = re.match(r'^\s*([VAS][A-Z.]{5})\s+(\S+)', line)
+        if match and match.group(2) != '=':
+            encoders.add(match.group(2))
+    return encoders
+
+def find_v4l2_m2m_encoders(sysfs_root='/sys/class/video4linux'):
+    # e.g. /dev/video11 (bcm2835-codec-encode) on a Pi 4
+    devices = []
+    for name_file in sorted(glob.glob(os.path.join(sysfs_root, 'video*', 'name'))):
+        try:
+            with open(name_file, 'r') as file:
+                name = file.read().strip()
+        except OSError:
+            continue
+        if 'encode' in name.lower() and 'image' not in name.lower():
+            devices.append({"device": f"/dev/{os.path.basename(os.path.dirname(name_file))}", "name": name})
+    return devices
+
+def libx264_args(bitrate, keyframe_interval, profile):
+    return [
+        "-c:v", "libx264", "-preset", str(PRESET), "-tune", "zerolatency",
+        "-b:v", f"{bitrate}k", "-maxrate", f"{bitrate}k", "-bufsize", f"{bitrate * 2}k",
+        "-g", str(keyframe_interval),
+        "-profile:v", profile
+    ]
 
-    state = load_state()
+def h264_v4l2m2m_args(bitrate, keyframe_interval, profile):
+    # The M2M wrapper takes numeric profiles and has no preset/tune/VBV options
+    return [
+        "-c:v", "h264_v4l2m2m",
+        "-b:v", f"{bitrate}k",
+        "-g", str(keyframe_interval),
+        "-profile:v", str(H264_PROFILE_IDS.get(profile, H264_PROFILE_IDS["high"]))
+    ]
 
-    if state["streaming"]:
-        return
+# Encoder backends in order of preference for ENCODER=auto
+ENCODER_BACKENDS = {
+    "h264_v4l2m2m": h264_v4l2m2m_args,
+    "libx264": libx264_args
+}
+
+def select_encoder_backend(requested, ffmpeg_encoders, m2m_devices):
+    # (backend, reason) for ENCODER given what ffmpeg and the board support
+    def available(backend):
+        if backend not in ffmpeg_encoders:
+            return False
+        if backend == "h264_v4l2m2m":
+            return bool(m2m_devices)
+        return True
+
+    requested = (requested or 'auto').lower()
+    if requested != 'auto':
+        if requested not in ENCODER_BACKENDS:
+            return "libx264", f"Unknown ENCODER '{requested}', using libx264"
+        if available(requested):
+            return requested, f"{requested} selected by ENCODER"
+        return "libx264", f"{requested} is not available, falling back to libx264"
+
+    for backend in ENCODER_BACKENDS:
+        if available(backend):
+            return backend, f"{backend} selected automatically"
+    return "libx264", "No supported encoder found by probing, using libx264"
+
+def probe_encoders():
+    # H.264 encoders from ffmpeg and sysfs
+    try:
+        output = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logging.error(f"Failed to list ffmpeg encoders: {e}")
+        output = ''
+    ffmpeg_encoders = parse_ffmpeg_codecs(output)
+    try:
+        output = subprocess.run(["ffmpeg", "-hide_banner", "-decoders"], capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logging.error(f"Failed to list ffmpeg decoders: {e}")
+        output = ''
+    ffmpeg_decoders = parse_ffmpeg_codecs(output)
+    m2m_devices = find_v4l2_m2m_encoders()
+    backend, reason = select_encoder_backend(ENCODER, ffmpeg_encoders, m2m_devices)
+    logging.debug(f"Encoder backend: {reason}")
+    return {
+        "backend": backend,
+        "reason": reason,
+        "requested": ENCODER,
+        "ffmpeg_encoders": sorted(encoder for encoder in ffmpeg_encoders if encoder in ENCODER_BACKENDS),
+        "mjpeg_decoders": [decoder for decoder in HW_MJPEG_DECODERS if decoder in ffmpeg_decoders],
+        "m2m_devices": m2m_devices
+    }
 
-    logging.debug("Starting stream...")
+# Replaced by probe_encoders() during hardware discovery
+encoder_info = {
+    "backend": "libx264",
+    "reason": "Probing encoders",
+    "requested": ENCODER,
+    "ffmpeg_encoders": [],
+    "mjpeg_decoders": [],
+    "m2m_devices": []
+}
+
+def encoder_args(bitrate=None):
+    return ENCODER_BACKENDS[encoder_info["backend"]](bitrate or BITRATE, KEYFRAME_INTERVAL, ENCODER_PROFILE)
+
+# Pixel formats each encoder backend takes without a conversion (4:2:0, as the high profile needs)
+ENCODER_PIXEL_FORMATS = {
+    "libx264": ("yuv420p", "yuvj420p", "nv12", "nv21"),
+    "h264_v4l2m2m": ("yuv420p", "nv12", "nv21")
+}
+# Pixel format each capture format arrives in once decoded
+DECODED_PIXEL_FORMATS = {"mjpeg": "yuvj422p", "yuyv422": "yuyv422", "uyvy422": "uyvy422", "nv12": "nv12", "yuv420p": "yuv420p", "rgb24": "rgb24"}
+# Capture formats to try when the configured one cannot deliver the size and frame rate, cheapest USB bandwidth first
+CAPTURE_FORMAT_PREFERENCE = ("mjpeg", "nv12", "yuv420p", "yuyv422")
+
+def parse_size(size):
+    width, height = (int(value) for value in str(size).lower().split('x'))
+    return width, height
+
+def find_capture_size(sizes, video_size, frame_rate):
+    # Smallest size that is at least video_size and runs at frame_rate
+    if video_size in sizes and frame_rate in sizes[video_size]:
+        return video_size
+    width, height = parse_size(video_size)
+    candidates = []
+    for size, fps_list in sizes.items():
+        capture_width, capture_height = parse_size(size)
+        if capture_width >= width and capture_height >= height and frame_rate in fps_list:
+            candidates.append((capture_width * capture_height, size))
+    return min(candidates)[1] if candidates else None
+
+def plan_capture_path(capture_format, video_size, frame_rate, backend, modes, mjpeg_decoders=(), allow_format_change=True,
+                      output_size=None):
+    # Cheapest decode/convert chain from the camera to the encoder, scaled once to output_size
+    frame_rate = float(frame_rate)
+    notes = []
+    degraded = False
+    capture_size = video_size
+
+    if modes:
+        formats = [capture_format] if capture_format in modes else []
+        if allow_format_change:
+            formats += [name for name in CAPTURE_FORMAT_PREFERENCE if name in modes and name not in formats]
+        for name in formats:
+            size = find_capture_size(modes[name], video_size, frame_rate)
+            if size:
+                if name != capture_format:
+                    notes.append(f"{capture_format} cannot deliver {video_size} at {frame_rate:g} fps, using {name}")
+                capture_format, capture_size = name, size
+                break
+        else:
+            degraded = True
+            notes.append(f"No capture mode delivers {video_size} at {frame_rate:g} fps, the camera may lower the frame rate")
+
+    input_args = []
+    chain = [f"{capture_format} {capture_size}"]
+    if capture_format == "mjpeg" and mjpeg_decoders:
+        input_args = ["-c:v", mjpeg_decoders[0]]
+        decoded = "yuv420p"
+        chain.append(f"hardware decode ({mjpeg_decoders[0]})")
+    else:
+        decoded = DECODED_PIXEL_FORMATS.get(capture_format, capture_format)
+        if capture_format == "mjpeg":
+            chain.append("software MJPEG decode")
+
+    filters = []
+    output_size = output_size or video_size
+    if capture_size != output_size:
+        width, height = parse_size(output_size)
+        filters.append(f"scale={width}:{height}")
+    if decoded not in ENCODER_PIXEL_FORMATS.get(backend, ("yuv420p",)):
+        filters.append("format=yuv420p")
+
+    if filters:
+        # Scale and pixel format conversion happen in one swscale pass
+        chain.append(" + ".join(filters))
+    else:
+        chain.append(f"native {decoded} handoff")
+    chain.append(backend)
+
+    return {
+        "input_format": capture_format,
+        "capture_size": capture_size,
+        "input_args": input_args,
+        "filter": ",".join(filters) or None,
+        "chain": " -> ".join(chain),
+        "notes": notes,
+        "degraded": degraded
+    }
 
-    start_max_timer()
+def get_capture_plan(output_size=None):
+    return plan_capture_path(FORMAT, VIDEO_SIZE, FRAME_RATE, encoder_info["backend"], get_device_modes(),
+                             encoder_info["mjpeg_decoders"], allow_format_change=CAPTURE_PATH == 'auto', output_size=output_size)
+
+def validate_capture_config(data):
+    # Error message if the camera would have to drop frames
+    modes = get_device_modes()
+    if not modes:
+        return None
+    try:
+        capture_format = data.get('FORMAT', FORMAT)
+        video_size = data.get('VIDEO_SIZE', VIDEO_SIZE)
+        frame_rate = float(data.get('FRAME_RATE', FRAME_RATE))
+        plan = plan_capture_path(capture_format, video_size, frame_rate, encoder_info["backend"], modes,
+                                 allow_format_change=data.get('CAPTURE_PATH', CAPTURE_PATH) == 'auto')
+    except ValueError:
+        return "Invalid Video Size or Frame Rate."
+    if plan["degraded"]:
+        supported = sorted(modes.get(capture_format, {}).get(video_size, []), reverse=True)
+        supported_text = ", ".join(f"{fps:g}" for fps in supported) if supported else "none"
+        return f"{capture_format} {video_size} cannot run at {frame_rate:g} fps on this device (supported: {supported_text})."
+    return None
 
-    # Reinitialize the video device before starting the recording
-    reinitialize_device()
+def scaled_size(video_size, height):
+    # Same aspect ratio, even width
+    width, original_height = parse_size(video_size)
+    return f"{round(width * height / original_height / 2) * 2}x{height}"
+
+def capture_args(output_height=None):
+    output_size = scaled_size(VIDEO_SIZE, output_height) if output_height and VIDEO_SIZE else None
+    plan = get_capture_plan(output_size)
+    args = [
+        "-f", "v4l2", "-framerate", str(FRAME_RATE), "-video_size", plan["capture_size"], "-input_format", plan["input_format"],
+        *plan["input_args"], "-i", "/dev/video0"
+    ]
+    filter_args = ["-vf", plan["filter"]] if plan["filter"] else []
+    return args, filter_args
 
+def build_stream_command():
+    bitrate, output_height = adaptive_bitrate.current()
+    video_input_args, video_filter_args = capture_args(output_height)
     stream_command = [
         "ffmpeg",
         "-itsoffset", str(AUDIO_OFFSET),  # Adjust the offset value for audio sync
         "-thread_queue_size", "1024",
         "-f", "alsa", "-ac", "2", "-i", str(ALSA_AUDIO_SOURCE),  # Input from ALSA
-        "-f", "v4l2", "-framerate", str(FRAME_RATE), "-video_size", str(VIDEO_SIZE), "-input_format", str(FORMAT), "-i", "/dev/video0",  # Video input settings
+        *video_input_args,  # Video input settings
         "-probesize", "32", "-analyzeduration", "0",  # Lower probing size and analysis duration for reduced latency
-        "-c:v", "libx264", "-preset", str(PRESET), "-tune", "zerolatency", "-b:v", f"{BITRATE}k", "-maxrate", f"{BITRATE}k", "-bufsize", f"{BUFFER_SIZE}k",  # Video encoding settings
-        "-vf", "format=yuv420p", "-g", str(KEYFRAME_INTERVAL),  # Keyframe interval
+        *encoder_args(bitrate),  # Video encoding settings, at the adaptive bitrate when ADAPTIVE_BITRATE is on
+        *video_filter_args,  # Decode/convert chain chosen by the capture planner
         "-color_range", "tv",
-        "-profile:v", "high",
         "-c:a", "aac", "-b:a", "96k", "-ar", "44100",  # Audio encoding settings
         "-use_wallclock_as_timestamps", "1",  # Use wallclock timestamps
         "-flush_packets", "1",  # Flush packets
         "-async", "1",  # Sync audio with video
-        "-f", "flv", f"{RTMP_SERVER}{STREAM_KEY}"  # Output to RTMP server
     ]
 
+    output_file = None
+    relay_ports = simulcast.ports()
+    if relay_ports:
+        # Simulcast: encode once and send MPEG-TS to a local relay per destination. UDP never blocks, so a
+        # slow or failing destination only affects its own relay. dump_extra repeats the codec headers
+        # on keyframes so a restarted relay can join mid-stream.
+        slaves = [f"[f=mpegts:onfail=ignore:bsfs/v=dump_extra]udp://127.0.0.1:{port}?pkt_size=1316" for port in relay_ports]
+        if stream_tee_recording:
+            output_file = f"recordings/stream_{int(time.time())}_%03d.mp4"
+            slaves.append(f"[f=segment:segment_time={RECORD_SEGMENT_TIME}:segment_format=mp4:reset_timestamps=1"
+                          f":segment_format_options=movflags={FRAGMENTED_MP4_FLAGS}:onfail=ignore]{output_file}")
+        stream_command += [
+            "-map", "0:a", "-map", "1:v",
+            "-flags", "+global_header",
+            "-f", "tee", "|".join(slaves)
+        ]
+    elif stream_tee_recording:
+        # Encode once and fan out to RTMP and local segments. Each output fails independently:
+        # the RTMP side runs through the fifo muxer so it can reconnect without stopping the recording.
+        output_file = f"recordings/stream_{int(time.time())}_%03d.mp4"
+        stream_command += [
+            "-map", "0:a", "-map", "1:v",
+            "-flags", "+global_header",  # Both outputs need the codec headers up front
+            "-f", "tee",
+            "-fifo_options", "attempt_recovery=1:recover_any_error=1:recovery_wait_time=2:drop_pkts_on_overflow=1",
+            f"[f=flv:onfail=ignore:use_fifo=1]{RTMP_SERVER}{STREAM_KEY}"
+            f"|[f=segment:segment_time={RECORD_SEGMENT_TIME}:segment_format=mp4:reset_timestamps=1"
+            f":segment_format_options=movflags={FRAGMENTED_MP4_FLAGS}:onfail=ignore]{output_file}"
+        ]
+    else:
+        stream_command += ["-f", "flv", f"{RTMP_SERVER}{STREAM_KEY}"]  # Output to RTMP server
+
     if REPORT:
         stream_command.insert(1, "-report")  # Insert the -report flag at index 1 in the command list if REPORT is true in the .env file
 
-    stream_process = subprocess.Popen(stream_command)
+    return stream_command, output_file
+
+# Fragmented MP4 writes the index up front and per fragment, so files never need a remux to be playable
+FRAGMENTED_MP4_FLAGS = "+frag_keyframe+empty_moov+default_base_moof"
+
+def recording_output_args(mode, prefix):
+    # (output arguments, output file) for RECORD_MODE
+    timestamp = int(time.time())
+    if mode == 'segment':
+        output_file = f"recordings/{prefix}_{timestamp}_%03d.mp4"
+        return [
+            "-f", "segment", "-segment_time", str(RECORD_SEGMENT_TIME), "-segment_format", "mp4",
+            "-reset_timestamps", "1", "-segment_format_options", f"movflags={FRAGMENTED_MP4_FLAGS}",
+            output_file
+        ], output_file
+    output_file = f"recordings/{prefix}_{timestamp}.mp4"
+    if mode == 'fragmented':
+        return ["-movflags", FRAGMENTED_MP4_FLAGS, "-f", "mp4", output_file], output_file
+    return ["-f", "mp4", output_file], output_file
+
+# RECORD_MODE of the running recordings, so a settings change does not mix modes within one recording
+recording_mode = RECORD_MODE
+stream_recording_mode = RECORD_MODE
+
+def build_record_command():
+    output_args, output_file = recording_output_args(recording_mode, "recording")
+    video_input_args, video_filter_args = capture_args()
+    record_command = [
+        "ffmpeg",
+        "-itsoffset", str(AUDIO_OFFSET),  # Adjust the offset value for audio sync
+        "-thread_queue_size", "1024",
+        "-f", "alsa", "-ac", "2", "-i", str(ALSA_AUDIO_SOURCE),  # Input from ALSA
+        *video_input_args,  # Video input settings
+        *encoder_args(),  # Video encoding settings
+        *video_filter_args,  # Decode/convert chain chosen by the capture planner
+        "-color_range", "tv",
+        "-c:a", "aac", "-b:a", "96k", "-ar", "44100",  # Audio encoding settings
+        "-use_wallclock_as_timestamps", "1",  # Use wallclock timestamps
+        "-flush_packets", "1",  # Flush packets
+        "-async", "1",  # Sync audio with video
+        *output_args  # Output to MP4 file(s)
+    ]
+
+    if REPORT:
+        record_command.insert(1, "-report")  # Insert the -report flag at index 1 in the command list if REPORT is true in the .env file
+
+    return record_command, output_file
+
+def build_stream_record_command():
+    output_args, output_file = recording_output_args(stream_recording_mode, "stream")
+    stream_record_command = [
+        "ffmpeg",
+        "-y",  # Automatically overwrite output file if it exists
+        "-re",
+        "-i", str(STREAM_M3U8_URL),
+        "-c:v", "copy",
+        "-c:a", "copy",
+        *output_args
+    ]
+    return stream_record_command, output_file
+
+def build_file_stream_command():
+    if os.path.isfile(STREAM_FILE) and not STREAM_FILE.endswith('.txt'):
+        logging.debug(f"Streaming single file: {STREAM_FILE}")
+        file_stream_command = [
+            "ffmpeg",
+            "-re",  # Read input at native frame rate
+            "-stream_loop", "-1",  # Loop the input file indefinitely
+            "-i", media_library.resolve(STREAM_FILE),  # Input file, or its normalized copy
+            "-c:v", "copy",  # Copy the video codec
+            "-c:a", "aac",  # Audio codec
+            "-strict", "-2",  # Allow experimental codecs
+            "-ac", "2",  # Set number of audio channels
+            "-b:a", "96k",  # Audio bitrate
+            "-ar", "44100",  # Audio sampling rate
+            "-bufsize", "2M",  # Set buffer size for the stream
+            "-f", "flv",  # Output format
+            f"{RTMP_SERVER}{STREAM_KEY}"  # RTMP server URL and stream key
+        ]
+    else:
+        raise ValueError(f"{STREAM_FILE} not found or invalid format. Cannot start file streaming.")
+
+    if REPORT:
+        file_stream_command.insert(1, "-report")  # Insert the -report flag at index 1 in the command list if REPORT is true in the .env file
+
+    return file_stream_command, None
+
+# True while the stream pipeline also writes the local Stream & Record copy (tee mode)
+stream_tee_recording = False
+
+def get_stream_record_mode():
+    if STREAM_RECORD_MODE:
+        return STREAM_RECORD_MODE.lower()
+    # Recording the stream back needs an m3u8 URL, otherwise use the single encode
+    return 'hls' if STREAM_M3U8_URL else 'tee'
+
+def stream_gave_up():
+    # Reconcile the state with the stream that could not be restarted
+    if load_state()["streaming_and_recording"]:
+        stop_stream_recording()
+    stop_stream()
+
+def stream_record_gave_up():
+    logging.error("Stream recording could not be restarted. The stream is still live.")
+
+# Playlist engine: one persistent RTMP connection fed item by item, so queue edits never reconnect
+# Seconds before the current item ends to start the next one, so it is ready when the current one finishes
+PLAYLIST_PREOPEN = 2
+# Bytes copied from an item to the output at a time
+PLAYLIST_CHUNK_SIZE = 65536
+
+def parse_playlist_file(path):
+    # Paths from a concat demuxer playlist (as written by create_playlist.sh)
+    paths = []
+    with open(path, 'r') as file:
+        for line in file:
+            match = re.match(r"\s*file\s+'(.*)'\s*$", line) or re.match(r"\s*file\s+(\S+)\s*$", line)
+            if match:
+                # Relative entries are relative to the playlist, as for the concat demuxer
+                paths.append(os.path.join(os.path.dirname(os.path.abspath(path)), match.group(1).replace("'\\''", "'")))
+    return paths
+
+def build_playlist_output_command():
+    # Long-lived output: MPEG-TS on stdin, copied to the RTMP server
+    output_command = [
+        "ffmpeg",
+        "-fflags", "+genpts+discardcorrupt",
+        "-f", "mpegts", "-i", "pipe:0",  # Items are written here one after another
+        "-map", "0",
+        "-c", "copy",
+        "-f", "flv",  # Output format
+        f"{RTMP_SERVER}{STREAM_KEY}"  # RTMP server URL and stream key
+    ]
+    if REPORT:
+        output_command.insert(1, "-report")  # Insert the -report flag at index 1 in the command list if REPORT is true in the .env file
+    return output_command, None
+
+def build_playlist_item_command(path, info, offset):
+    # Real-time MPEG-TS with timestamps continuing from the last item
+    item_command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", "-re", "-i", path]
+    if info["audio_codec"]:
+        item_command += ["-map", "0:v:0", "-map", "0:a:0"]
+    else:
+        # Keep the audio stream the output expects
+        item_command += ["-f", "lavfi", "-i", "anullsrc=r=44100:cl=stereo", "-map", "0:v:0", "-map", "1:a", "-shortest"]
+    item_command += [
+        "-c:v", "copy",  # Copy the video codec
+        "-c:a", "aac", "-b:a", "96k", "-ar", str(MEDIA_AUDIO_SAMPLE_RATE), "-ac", str(MEDIA_AUDIO_CHANNELS),  # Same audio for every item
+        "-output_ts_offset", f"{offset:.3f}",
+        "-muxdelay", "0",
+        "-f", "mpegts", "pipe:1"
+    ]
+    return item_command
+
+class PlaylistEngine:
+    # Item ffmpegs pipe into one output ffmpeg, so queue edits keep the RTMP connection
+
+    def __init__(self):
+        self.items = []
+        self.current = None
+        # The item that followed the current one when the current one was removed from the queue
+        self._successor = None
+        self.offset = 0.0
+        self.output = FfmpegSupervisor('playlist', build_playlist_output_command, on_give_up=lambda: stop_file_stream(), stdin=subprocess.PIPE)
+        self._lock = RLock()
+        self._next_id = 0
+        self._feeder = None
+        self._preopened = None
+        self._preopen_thread = None
+        self._skip = Event()
+        self._stopping = Event()
+        self._thread = None
+
+    def is_active(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def load(self, paths):
+        with self._lock:
+            self.items = []
+            for path in paths:
+                self._add(path)
+
+    def _add(self, path):
+        self._next_id += 1
+        item = {"id": self._next_id, "path": path, "name": os.path.basename(path)}
+        self.items.append(item)
+        return item
+
+    def append(self, path):
+        with self._lock:
+            return self._add(path)
+
+    def remove(self, item_id):
+        with self._lock:
+            if self.current in self.items and self.current["id"] == item_id:
+                index = self.items.index(self.current)
+                following = self.items[index + 1:] + self.items[:index]
+                self._successor = following[0] if following else None
+            self.items = [item for item in self.items if item["id"] != item_id]
+        if self.current and self.current["id"] == item_id:
+            self.skip()
+
+    def move(self, item_id, index):
+        with self._lock:
+            item = next((item for item in self.items if item["id"] == item_id), None)
+            if item is None:
+                raise ValueError(f"No playlist item {item_id}")
+            self.items.remove(item)
+            self.items.insert(max(0, min(index, len(self.items))), item)
+
+    def shuffle(self):
+        # The item playing now stays first
+        with self._lock:
+            rest = [item for item in self.items if not self.current or item["id"] != self.current["id"]]
+            random.shuffle(rest)
+            self.items = ([self.current] if self.current in self.items else []) + rest
+
+    def skip(self):
+        self._skip.set()
+        feeder = self._feeder
+        if feeder and feeder.poll() is None:
+            feeder.kill()
+
+    def status(self):
+        with self._lock:
+            return {"active": self.is_active(), "current": self.current, "items": list(self.items), "offset": round(self.offset, 3)}
+
+    def start(self):
+        if self.is_active():
+            return False
+        with self._lock:
+            if not self.items:
+                raise ValueError("The playlist is empty.")
+        self._stopping.clear()
+        self.offset = 0.0
+        self.current = self._successor = None
+        self.output.start()
+        self._thread = Thread(target=self._play, name="playlist", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stopping.set()
+        self.skip()
+        self._discard_preopened()
+        thread = self._thread
+        if thread and thread is not current_thread():
+            thread.join(timeout=10)
+        self._thread = None
+        self.output.stop()
+        self.current = None
+
+    def _next_item(self):
+        # Wraps around
+        with self._lock:
+            if not self.items:
+                return None
+            if self.current in self.items:
+                return self.items[(self.items.index(self.current) + 1) % len(self.items)]
+            if self._successor in self.items:
+                return self._successor
+            return self.items[0]
+
+    def _open(self, item, offset):
+        path = media_library.resolve(item["path"])
+        info = probe_recording(path)
+        if not info["video_codec"]:
+            logging.error(f"Playlist: skipping {item['path']}, no video stream found")
+            return None
+        process = subprocess.Popen(build_playlist_item_command(path, info, offset), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return {"item": item, "process": process, "duration": info["duration"] or 0, "offset": offset, "started_at": None}
+
+    def _preopen(self, item, offset):
+        # On its own thread, so the ffprobe and Popen do not stall writes to the output
+        self._preopened = self._open(item, offset)
+
+    def _wait_preopen(self):
+        thread, self._preopen_thread = self._preopen_thread, None
+        if thread and thread is not current_thread():
+            thread.join()
+
+    def _discard_preopened(self):
+        self._wait_preopen()
+        preopened, self._preopened = self._preopened, None
+        if preopened and preopened["process"].poll() is None:
+            preopened["process"].kill()
+            preopened["process"].wait()
+
+    def _write(self, chunk):
+        process = self.output.process
+        if process is None or process.stdin is None:
+            return  # Output is restarting, drop the data as a live stream would
+        try:
+            process.stdin.buffer.write(chunk)
+            process.stdin.buffer.flush()
+        except (BrokenPipeError, ValueError, OSError):
+            pass
+
+    def _play(self):
+        failures = 0
+        while not self._stopping.is_set():
+            item = self._next_item()
+            if item is None:
+                logging.error("Playlist: the queue is empty, stopping.")
+                break
+            self._wait_preopen()
+            preopened, self._preopened = self._preopened, None
+            if preopened and preopened["item"] is item and preopened["offset"] == self.offset:
+                playing = preopened
+            else:
+                if preopened:
+                    self._preopened = preopened
+                    self._discard_preopened()
+                playing = self._open(item, self.offset)
+            with self._lock:
+                self.current = item
+            if playing is None:
+                failures += 1
+                if failures >= len(self.items):
+                    logging.error("Playlist: no playable items, stopping.")
+                    break
+                continue
+            failures = 0
+            logging.debug(f"Playlist: playing {item['path']} at {self.offset:.1f}s")
+
+            self._skip.clear()
+            self._feeder = playing["process"]
+            # -re paces from the first read, a pre-opened item has been waiting on a full pipe
+            playing["started_at"] = time.time()
+            fd = playing["process"].stdout.fileno()
+            while True:
+                chunk = os.read(fd, PLAYLIST_CHUNK_SIZE)
+                if not chunk or self._stopping.is_set():
+                    break
+                self._write(chunk)
+                remaining = playing["duration"] - (time.time() - playing["started_at"])
+                if self._preopen_thread is None and self._preopened is None and remaining < PLAYLIST_PREOPEN and not self._skip.is_set():
+                    next_item = self._next_item()
+                    if next_item is not None:
+                        self._preopen_thread = Thread(target=self._preopen, args=(next_item, playing["offset"] + playing["duration"]), name="playlist-preopen", daemon=True)
+                        self._preopen_thread.start()
+            playing["process"].wait()
+            self._feeder = None
+
+            if self._skip.is_set():
+                # Continue the timeline from where the skipped item stopped
+                self.offset = playing["offset"] + min(time.time() - playing["started_at"], playing["duration"] or float('inf'))
+                self._discard_preopened()
+            else:
+                self.offset = playing["offset"] + playing["duration"]
+        self._discard_preopened()
+        if not self._stopping.is_set():
+            # Ended on its own: close the output and clear file_streaming
+            stop_file_stream()
+
+stream_supervisor = FfmpegSupervisor('stream', build_stream_command, target_fps=FRAME_RATE, on_give_up=stream_gave_up, uses_capture_device=True)
+record_supervisor = FfmpegSupervisor('record', build_record_command, target_fps=FRAME_RATE, on_give_up=lambda: stop_recording(), uses_capture_device=True)
+stream_record_supervisor = FfmpegSupervisor('stream_record', build_stream_record_command, on_give_up=stream_record_gave_up)
+file_stream_supervisor = FfmpegSupervisor('file_stream', build_file_stream_command, on_give_up=lambda: stop_file_stream())
+playlist_engine = PlaylistEngine()
+supervisors = (stream_supervisor, record_supervisor, stream_record_supervisor, file_stream_supervisor, playlist_engine.output)
+
+# Adaptive bitrate (ADAPTIVE_BITRATE): fractions of BITRATE for each step, and the output height tiers the lower steps may use
+ADAPTIVE_STEPS = (1.0, 0.75, 0.55, 0.4, 0.3)
+ADAPTIVE_HEIGHTS = (1080, 720, 480, 360)
+# Seconds between checks of the stream's progress and socket backlog
+ADAPTIVE_INTERVAL = 2
+# Congested: more than this many seconds of video waiting in the socket send queue, or encoding slower than real time
+ADAPTIVE_MAX_BACKLOG = 1.0
+ADAPTIVE_MIN_SPEED = 0.95
+# Clear: less than this backlog and real-time speed
+ADAPTIVE_CLEAR_BACKLOG = 0.25
+# Step down after this many seconds congested, step up after ADAPTIVE_UP_AFTER seconds clear.
+# A step up that is followed by a step down within ADAPTIVE_UP_AFTER doubles the wait for the next one.
+ADAPTIVE_DOWN_AFTER = 4
+ADAPTIVE_UP_AFTER_MAX = 600
+# Seconds to ignore the signals after a change while the encoder and connection settle
+ADAPTIVE_SETTLE = 10
+
+def adaptive_ladder(bitrate, video_size, with_resolution=False, min_bitrate=800):
+    # [(bitrate kbps, height or None)] from the configured quality down
+    try:
+        height = parse_size(video_size)[1]
+    except (ValueError, TypeError):
+        height = None
+    lower_heights = [tier for tier in ADAPTIVE_HEIGHTS if height and tier < height]
+    ladder = []
+    for index, step in enumerate(ADAPTIVE_STEPS):
+        level_bitrate = max(int(bitrate * step), min(min_bitrate, bitrate))
+        # The two lowest steps drop one and two resolution tiers
+        tier = index - (len(ADAPTIVE_STEPS) - 3)
+        level_height = lower_heights[min(tier, len(lower_heights)) - 1] if with_resolution and tier > 0 and lower_heights else None
+        if ladder and ladder[-1] == (level_bitrate, level_height):
+            continue
+        ladder.append((level_bitrate, level_height))
+    return ladder
+
+def socket_send_backlog(pid):
+    # Bytes queued on the process' RTMP socket, from /proc/net/tcp
+    try:
+        process = psutil.Process(pid)
+        connections = process.net_connections(kind='tcp') if hasattr(process, 'net_connections') else process.connections(kind='tcp')
+    except psutil.Error:
+        return None
+    ports = {(connection.laddr.port, connection.raddr.port) for connection in connections
+             if connection.status == psutil.CONN_ESTABLISHED and connection.raddr}
+    if not ports:
+        return None
+    backlog = 0
+    for table in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(table, 'r') as file:
+                next(file)
+                for line in file:
+                    columns = line.split()
+                    local_port = int(columns[1].rsplit(':', 1)[1], 16)
+                    remote_port = int(columns[2].rsplit(':', 1)[1], 16)
+                    if (local_port, remote_port) in ports:
+                        backlog += int(columns[4].split(':')[0], 16)
+        except OSError:
+            continue
+    return backlog
+
+class AdaptiveBitrate:
+    # Steps the stream along adaptive_ladder() on RTMP backpressure, restarting it for each change
+
+    def __init__(self):
+        self.level = 0
+        self.up_after = current_config.ADAPTIVE_UP_AFTER
+        self.last_change = 0
+        self.last_step_up = None
+        self.congested_since = None
+        self.clear_since = None
+        self.last_sample = {}
+        self.changes = deque(maxlen=20)
+        self.costs = {"restart": deque(maxlen=20)}
+        self._lock = RLock()
+
+    def ladder(self):
+        config = current_config
+        return adaptive_ladder(config.BITRATE, config.VIDEO_SIZE, config.ADAPTIVE_RESOLUTION, config.ADAPTIVE_MIN_BITRATE)
+
+    def current(self):
+        # (bitrate kbps, height or None)
+        if not current_config.ADAPTIVE_BITRATE:
+            return BITRATE, None
+        ladder = self.ladder()
+        with self._lock:
+            return ladder[min(self.level, len(ladder) - 1)]
+
+    def reset(self):
+        with self._lock:
+            self.level = 0
+            self.up_after = current_config.ADAPTIVE_UP_AFTER
+            self.last_change = time.time()
+            self.last_step_up = None
+            self.congested_since = None
+            self.clear_since = None
+
+    def sample(self):
+        # None when the stream is not running
+        process = stream_supervisor.process
+        if not process or process.poll() is not None:
+            return None
+        with encoder_metrics_lock:
+            metrics = dict(encoder_metrics.get('stream', {}))
+        if metrics.get("pid") != process.pid:
+            return None
+        bitrate = self.current()[0]
+        # When simulcasting the RTMP sockets belong to the relays; the most backed up one decides
+        backlogs = [socket_send_backlog(pid) for pid in [process.pid] + simulcast.relay_pids()]
+        backlogs = [backlog for backlog in backlogs if backlog is not None]
+        backlog = max(backlogs) if backlogs else None
+        updated_at = metrics.get("updated_at")
+        return {
+            "time": time.time(),
+            "speed": metrics.get("speed"),
+            "bitrate_kbps": metrics.get("bitrate_kbps"),
+            "drop_frames": metrics.get("drop_frames"),
+            "backlog_bytes": backlog,
+            "backlog_seconds": round(backlog * 8 / 1000 / bitrate, 3) if backlog is not None and bitrate else None,
+            # ffmpeg stops reporting when a write to the socket blocks
+            "stalled": updated_at is None and time.time() - metrics.get("started_at", time.time()) > ADAPTIVE_SETTLE
+                       or updated_at is not None and time.time() - updated_at > ADAPTIVE_INTERVAL * 3
+        }
+
+    def check(self):
+        sample = self.sample()
+        self.last_sample = sample or {}
+        now = time.time()
+        if sample is None or now - self.last_change < ADAPTIVE_SETTLE:
+            self.congested_since = self.clear_since = None
+            return
+
+        backlog = sample["backlog_seconds"]
+        speed = sample["speed"]
+        congested = sample["stalled"] or (backlog is not None and backlog > ADAPTIVE_MAX_BACKLOG) or (speed is not None and speed < ADAPTIVE_MIN_SPEED)
+        clear = not congested and (backlog is None or backlog < ADAPTIVE_CLEAR_BACKLOG) and (speed is None or speed >= 0.99)
+        self.congested_since = (self.congested_since or now) if congested else None
+        self.clear_since = (self.clear_since or now) if clear else None
+
+        ladder = self.ladder()
+        if self.congested_since and now - self.congested_since >= ADAPTIVE_DOWN_AFTER and self.level < len(ladder) - 1:
+            if self.last_step_up and now - self.last_step_up < self.up_after:
+                # The last step up did not hold, wait longer before trying again
+                self.up_after = min(self.up_after * 2, ADAPTIVE_UP_AFTER_MAX)
+            signals = [f"send backlog {backlog}s" if backlog is not None and backlog > ADAPTIVE_MAX_BACKLOG else None,
+                       f"speed {speed}x" if speed is not None and speed < ADAPTIVE_MIN_SPEED else None,
+                       "progress stalled" if sample["stalled"] else None]
+            self.change(self.level + 1, "congested: " + ", ".join(signal for signal in signals if signal))
+        elif self.clear_since and now - self.clear_since >= self.up_after and self.level > 0:
+            self.last_step_up = now
+            self.change(self.level - 1, f"clear for {now - self.clear_since:.0f}s")
+
+    def change(self, level, reason):
+        old_bitrate = self.current()[0]
+        with self._lock:
+            self.level = level
+            self.last_change = time.time()
+            self.congested_since = self.clear_since = None
+        bitrate, height = self.current()
+        logging.info(f"Adaptive bitrate: {old_bitrate}k -> {bitrate}k{f' at {height}p' if height else ''} ({reason})")
+
+        started = time.time()
+        process = stream_supervisor.process
+        stream_supervisor.restart(f"adaptive bitrate {bitrate}k{f' {height}p' if height else ''}: {reason}")
+        if process:
+            Thread(target=self._measure_restart, args=(process.pid, started), daemon=True).start()
+        self.changes.append({"time": started, "level": level, "bitrate": bitrate, "height": height, "method": "restart", "reason": reason})
+
+    def _measure_restart(self, old_pid, started):
+        # Time until the new ffmpeg reports frames
+        deadline = started + 60
+        while time.time() < deadline:
+            with encoder_metrics_lock:
+                metrics = dict(encoder_metrics.get('stream', {}))
+            if metrics.get("pid") not in (None, old_pid) and metrics.get("frame"):
+                self.costs["restart"].append(round(metrics["updated_at"] - started, 3))
+                return
+            time.sleep(0.1)
+
+    def status(self):
+        bitrate, height = self.current()
+        with self._lock:
+            return {
+                "enabled": current_config.ADAPTIVE_BITRATE,
+                "level": self.level,
+                "bitrate": bitrate,
+                "height": height,
+                "ladder": self.ladder(),
+                "up_after": self.up_after,
+                "sample": self.last_sample,
+                "changes": list(self.changes),
+                "costs": {method: {
+                    "count": len(costs),
+                    "last_seconds": costs[-1] if costs else None,
+                    "median_seconds": round(sorted(costs)[len(costs) // 2], 3) if costs else None
+                } for method, costs in self.costs.items()}
+            }
+
+def adaptive_bitrate_loop():
+    while True:
+        time.sleep(ADAPTIVE_INTERVAL)
+        if not current_config.ADAPTIVE_BITRATE:
+            continue
+        try:
+            adaptive_bitrate.check()
+        except Exception as e:
+            logging.error(f"Adaptive bitrate error: {e}")
+
+adaptive_bitrate = AdaptiveBitrate()
+Thread(target=adaptive_bitrate_loop, name="adaptive-bitrate", daemon=True).start()
+
+# Simulcast: further RTMP destinations next to RTMP_SERVER/STREAM_KEY, all fed from the one stream encode
+DESTINATIONS_FILE = 'destinations.json'
+# MPEG-TS packets (188 bytes) each relay buffers while its RTMP connection is slow, about 9 MB
+SIMULCAST_FIFO_SIZE = 50000
+
+def mask_stream_key(stream_key):
+    return f"...{stream_key[-4:]}" if stream_key and len(stream_key) > 8 else "..." if stream_key else None
+
+class Simulcast:
+    # Extra RTMP destinations, each fed by its own supervised relay from the one encode
+
+    def __init__(self, path):
+        self.path = path
+        self.relays = {}
+        self._ports = {}
+        self._lock = RLock()
+        self._active = False
+        # (mtime, destinations) of the last read, so /events does not read the file every second
+        self._loaded = None
+
+    def load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        except OSError as e:
+            logging.error(f"Failed to read {self.path}: {e}")
+            return []
+        with self._lock:
+            if self._loaded and self._loaded[0] == mtime:
+                return [dict(destination) for destination in self._loaded[1]]
+        try:
+            with open(self.path, 'r') as file:
+                destinations = [destination for destination in json.load(file) if isinstance(destination, dict)]
+        except (OSError, ValueError, TypeError) as e:
+            logging.error(f"Failed to read {self.path}: {e}")
+            destinations = []
+        with self._lock:
+            self._loaded = (mtime, destinations)
+        return [dict(destination) for destination in destinations]
+
+    def save(self, destinations):
+        tmp_file = f"{self.path}.tmp"
+        with open(tmp_file, 'w') as file:
+            json.dump(destinations, file, indent=4)
+        os.replace(tmp_file, self.path)
+        with self._lock:
+            self._loaded = (os.stat(self.path).st_mtime_ns, [dict(destination) for destination in destinations])
+
+    def destinations(self):
+        destinations = []
+        if RTMP_SERVER:
+            destinations.append({"id": "primary", "name": "Primary", "rtmp_server": RTMP_SERVER, "stream_key": STREAM_KEY or '', "enabled": True})
+        return destinations + self.load()
+
+    def enabled(self):
+        return [destination for destination in self.destinations() if destination.get("enabled", True)]
+
+    def find(self, destination_id):
+        return next((destination for destination in self.destinations() if destination["id"] == destination_id), None)
+
+    def ports(self):
+        # [] with a single destination
+        with self._lock:
+            if not self._active:
+                return []
+            return [self._ports[destination_id] for destination_id in sorted(self.relays)]
+
+    def supervisors(self):
+        with self._lock:
+            return tuple(self.relays.values())
+
+    def relay_pids(self):
+        with self._lock:
+            return [relay.process.pid for relay in self.relays.values() if relay.process]
+
+    def _relay_command(self, destination_id):
+        destination = self.find(destination_id)
+        if destination is None:
+            raise ValueError(f"Destination {destination_id} was removed")
+        port = self._ports[destination_id]
+        return [
+            "ffmpeg",
+            "-fflags", "+genpts+discardcorrupt",
+            "-f", "mpegts", "-i", f"udp://127.0.0.1:{port}?fifo_size={SIMULCAST_FIFO_SIZE}&overrun_nonfatal=1",
+            "-c", "copy",
+            "-f", "flv",
+            f"{destination['rtmp_server']}{destination['stream_key']}"
+        ], None
+
+    def _free_port(self):
+        used = set(self._ports.values())
+        port = current_config.SIMULCAST_BASE_PORT
+        while port in used:
+            port += 1
+        return port
+
+    def start(self):
+        with self._lock:
+            self._active = True
+        self.sync(restart_encoder=False)
+
+    def stop(self):
+        with self._lock:
+            self._active = False
+            relays = list(self.relays.values())
+            self.relays = {}
+            self._ports = {}
+        for relay in relays:
+            relay.stop()
+
+    def sync(self, restart_encoder=True):
+        if not self._active:
+            return
+        enabled = self.enabled()
+        wanted = {destination["id"] for destination in enabled} if len(enabled) > 1 else set()
+        with self._lock:
+            before = sorted(self.relays)
+            removed = []
+            for destination_id in [destination_id for destination_id in self.relays if destination_id not in wanted]:
+                removed.append(self.relays.pop(destination_id))
+                self._ports.pop(destination_id, None)
+            added = []
+            for destination_id in sorted(wanted - set(self.relays)):
+                self._ports[destination_id] = self._free_port()
+                relay = FfmpegSupervisor(f"relay_{destination_id}", lambda destination_id=destination_id: self._relay_command(destination_id),
+                                         on_give_up=lambda destination_id=destination_id: logging.error(f"Simulcast: gave up on destination {destination_id}"))
+                self.relays[destination_id] = relay
+                added.append(relay)
+            changed = sorted(self.relays) != before
+        for relay in removed:
+            relay.stop()
+        for relay in added:
+            relay.start()
+        if changed and restart_encoder and stream_supervisor.process:
+            stream_supervisor.restart("simulcast destinations changed")
+
+    def status(self):
+        with encoder_metrics_lock:
+            metrics = {name: dict(values) for name, values in encoder_metrics.items()}
+        with self._lock:
+            relays = dict(self.relays)
+        result = []
+        for destination in self.destinations():
+            relay = relays.get(destination["id"])
+            if relay:
+                supervisor, pipeline_metrics = relay, metrics.get(relay.name, {})
+            elif self._active and destination.get("enabled", True):
+                # Single destination: the stream pipeline writes to it directly
+                supervisor, pipeline_metrics = stream_supervisor, metrics.get('stream', {})
+            else:
+                supervisor, pipeline_metrics = None, {}
+            supervisor_status = supervisor.status() if supervisor else {}
+            updated_at = pipeline_metrics.get("updated_at")
+            result.append({
+                "id": destination["id"],
+                "name": destination.get("name", destination["id"]),
+                "rtmp_server": destination["rtmp_server"],
+                "stream_key": mask_stream_key(destination.get("stream_key")),
+                "enabled": destination.get("enabled", True),
+                "port": self._ports.get(destination["id"]),
+                "running": supervisor_status.get("running", False),
+                "healthy": bool(supervisor_status.get("running") and updated_at and time.time() - updated_at < 5),
+                "restarts": supervisor_status.get("restarts", 0),
+                "last_error": (supervisor_status.get("restart_reasons") or [{}])[-1].get("reason"),
+                "bytes_sent": pipeline_metrics.get("total_size"),
+                "bitrate_kbps": pipeline_metrics.get("bitrate_kbps")
+            })
+        return result
+
+simulcast = Simulcast(DESTINATIONS_FILE)
+
+def all_supervisors():
+    return supervisors + simulcast.supervisors()
+
+def start_stream():
+    global streaming
+
+    state = load_state()
+
+    if state["streaming"]:
+        return
+
+    logging.debug("Starting stream...")
+
+    start_max_timer()
+
+    # Reload the video device only if it is not healthy
+    prepare_capture_device()
+
+    # Every stream starts at the configured BITRATE
+    adaptive_bitrate.reset()
+    # Relays first, so they are listening when the encoder starts sending
+    simulcast.start()
+    stream_supervisor.start()
     logging.debug("Stream started!")
     streaming = True
-    state["streaming_and_recording"] = False
-    state["recording"] = False
-    state["streaming"] = True
-    state["start_time"] = time.time()
-    save_state(state)
+    update_state(streaming_and_recording=False, recording=False, streaming=True, start_time=time.time())
 
 def stop_stream():
-    global stream_process, streaming
+    global streaming
 
     state = load_state()
 
@@ -570,19 +3019,18 @@ def stop_stream():
         logging.debug("No active stream to stop.")
         return
 
-    if stream_process:
+    if stream_supervisor.is_active() or stream_supervisor.process:
         logging.debug("Stopping stream...")
-        stream_process.terminate()
-        stream_process.wait()
-        stream_process = None
+    stream_supervisor.stop()
+    simulcast.stop()
+    # Single-encode Stream & Record writes its segments from the stream pipeline
+    recording_catalog.invalidate()
     logging.debug("Stream stopped!")
     streaming = False
-    state["streaming"] = False
-    state["start_time"] = None
-    save_state(state)
+    update_state(streaming=False, start_time=None)
 
 def start_recording():
-    global record_process, recording
+    global recording, recording_mode
 
     state = load_state()
 
@@ -594,76 +3042,84 @@ def start_recording():
 
     start_max_timer()
 
-    # Reinitialize the video device before starting the recording
-    reinitialize_device()
-
-    record_command = [
-        "ffmpeg",
-        "-itsoffset", str(AUDIO_OFFSET),  # Adjust the offset value for audio sync
-        "-thread_queue_size", "1024",
-        "-f", "alsa", "-ac", "2", "-i", str(ALSA_AUDIO_SOURCE),  # Input from ALSA
-        "-f", "v4l2", "-framerate", str(FRAME_RATE), "-video_size", str(VIDEO_SIZE), "-input_format", str(FORMAT), "-i", "/dev/video0",  # Video input settings
-        "-c:v", "libx264", "-preset", str(PRESET), "-tune", "zerolatency", "-b:v", f"{BITRATE}k", "-maxrate", f"{BITRATE}k", "-bufsize", f"{BUFFER_SIZE}k",  # Video encoding settings
-        "-vf", "format=yuv420p", "-g", str(KEYFRAME_INTERVAL),  # Keyframe interval
-        "-color_range", "tv",
-        "-c:a", "aac", "-b:a", "96k", "-ar", "44100",  # Audio encoding settings
-        "-use_wallclock_as_timestamps", "1",  # Use wallclock timestamps
-        "-flush_packets", "1",  # Flush packets
-        "-async", "1",  # Sync audio with video
-        "-f", "mp4", f"recordings/recording_{int(time.time())}.mp4"  # Output to MP4 file
-    ]
-
-    if REPORT:
-        record_command.insert(1, "-report")  # Insert the -report flag at index 1 in the command list if REPORT is true in the .env file
+    # Reload the video device only if it is not healthy
+    prepare_capture_device()
 
-    record_process = subprocess.Popen(record_command)
+    recording_mode = RECORD_MODE
+    record_supervisor.start()
 
     logging.debug("Recording started!")
     recording = True
-    state["streaming"] = False
-    state["streaming_and_recording"] = False
-    state["recording"] = True
-    state["start_time"] = time.time()
-    save_state(state)
+    update_state(streaming=False, streaming_and_recording=False, recording=True, start_time=time.time())
+
+def finalize_recordings(supervisor, state_key, mode):
+    # One file per restart
+    recording_catalog.invalidate()
+    if mode != 'remux':
+        # Fragmented and segmented recordings are playable as written
+        logging.debug(f"Recording written as {mode} MP4, no remux needed.")
+        update_state(start_time=None, **{state_key: False})
+        return
+
+    recording_files = [output for output in supervisor.outputs if os.path.isfile(output)]
+    if recording_files:
+        # Update state to show remuxing is in progress
+        update_state(remux=True, start_time=None, **{state_key: False})
+
+        # Remux in the background, one file at a time
+        for recording_file in recording_files:
+            job_queue.submit("remux", [recording_file], recording_file)
+    else:
+        logging.error("Could not find a recording file to remux. Finalizing state.")
+        update_state(remux=False, start_time=None, **{state_key: False})
 
 def stop_recording():
-    global record_process, recording, remux
+    global recording
 
     state = load_state()
 
     if not state["recording"]:
         return
 
-    if record_process:
-        logging.debug("Stopping recording...")
-        record_process.terminate()
-        record_process.wait()
-        record_process = None
-
-        try:
-            # Get the latest recording file
-            recording_file = sorted(glob.glob('recordings/recording_*.mp4'))[-1]
-            
-            # Update state to show remuxing is in progress
-            state["remux"] = True
-            state["recording"] = False # The recording process is stopped
-            state["start_time"] = None
-            save_state(state)
-
-            # Start remuxing in a background thread
-            Thread(target=remux_and_finalize, args=(recording_file,)).start()
-
-        except IndexError:
-            logging.error("Could not find a recording file to remux. Finalizing state.")
-            state["recording"] = False
-            state["remux"] = False
-            state["start_time"] = None
-            save_state(state)
+    logging.debug("Stopping recording...")
+    record_supervisor.stop()
+    finalize_recordings(record_supervisor, "recording", recording_mode)
 
     recording = False
     logging.debug("Recording process stopped, remuxing in background.")
 
+def start_stream_and_record():
+    global stream_tee_recording, stream_recording
+
+    if get_stream_record_mode() != 'tee':
+        start_stream()
+        start_stream_recording()
+        return
+
+    if load_state()["streaming_and_recording"]:
+        return
+
+    ensure_recordings_directory()
+    logging.debug("Starting stream and recording (single encode)...")
+    stream_tee_recording = True
+    if stream_supervisor.is_active():
+        # Already streaming: the running command has no record output yet
+        stream_supervisor.restart("adding the tee recording")
+    else:
+        start_stream()
+    if not stream_supervisor.is_active():
+        stream_tee_recording = False
+        logging.error("Stream did not start, not recording.")
+        return
+    stream_recording = True
+    update_state(recording=False, streaming=False, streaming_and_recording=True)
+
+def stop_stream_and_record():
+    stop_stream()
+    stop_stream_recording()
+
 def delayed_start_recording():
+    global stream_recording_mode
     for _ in range(30):
         if stop_event.is_set():
             logging.debug("Delayed start recording process was stopped before it started.")
@@ -671,25 +3127,12 @@ def delayed_start_recording():
         time.sleep(1)
 
     if not stop_event.is_set():
-        stream_record_command = [
-            "ffmpeg",
-            "-y",  # Automatically overwrite output file if it exists
-            "-re",
-            "-i", str(STREAM_M3U8_URL),
-            "-c:v", "copy",
-            "-c:a", "copy",
-            "-f", "mp4",
-            f"recordings/stream_{int(time.time())}.mp4"
-        ]
-
-        global stream_record_process
-        stream_record_process = subprocess.Popen(stream_record_command)
+        stream_recording_mode = RECORD_MODE
+        stream_record_supervisor.start()
         logging.debug("Recording stream started!")
 
 def start_stream_recording():
-    global stream_record_process, stream_recording, stop_event
-
-    state = load_state()
+    global stream_recording
 
     if not STREAM_M3U8_URL:
         logging.error("STREAM_M3U8_URL is not set or is empty. Cannot start recording.")
@@ -701,60 +3144,42 @@ def start_stream_recording():
     start_max_timer()
 
     stream_recording = True
-    state["recording"] = False
-    state["streaming"] = False
-    state["streaming_and_recording"] = True
-    state["start_time"] = time.time()
-    save_state(state)
+    update_state(recording=False, streaming=False, streaming_and_recording=True, start_time=time.time())
 
     stop_event.clear()  # Clear the stop event before starting the thread
     Thread(target=delayed_start_recording).start()
 
 def stop_stream_recording():
-    global stream_record_process, stream_recording, stream_process, stop_event
+    global stream_recording, stream_tee_recording
 
     state = load_state()
 
     if not state["streaming_and_recording"]:
         return
 
+    if stream_tee_recording:
+        # The segments were written by the stream pipeline and are already playable
+        stream_tee_recording = False
+        stream_recording = False
+        update_state(streaming_and_recording=False, start_time=None)
+        logging.debug("Stream and Recording stopped.")
+        return
+
     if not STREAM_M3U8_URL:
         logging.error("STREAM_M3U8_URL is not set or is empty. Cannot stop recording.")
         return
 
     stop_event.set()  # Signal the delayed start thread to stop
 
-    if stream_record_process:
-        logging.debug("Stopping recording...")
-        stream_record_process.terminate()
-        stream_record_process.wait()
-        stream_record_process = None
-
-        try:
-            # Get the latest recording file
-            recording_file = sorted(glob.glob('recordings/stream_*.mp4'))[-1]
-            
-            # Update state to show remuxing is in progress
-            state["remux"] = True
-            state["streaming_and_recording"] = False
-            state["start_time"] = None
-            save_state(state)
-
-            # Start remuxing in a background thread
-            Thread(target=remux_and_finalize, args=(recording_file,)).start()
-
-        except IndexError:
-            logging.error("Could not find a stream recording file to remux. Finalizing state.")
-            state["streaming_and_recording"] = False
-            state["remux"] = False
-            state["start_time"] = None
-            save_state(state)
+    logging.debug("Stopping recording...")
+    stream_record_supervisor.stop()
+    finalize_recordings(stream_record_supervisor, "streaming_and_recording", stream_recording_mode)
 
     stream_recording = False
     logging.debug("Stream and Recording process stopped, remuxing in background.")
 
 def start_file_stream():
-    global file_stream_process, file_streaming
+    global file_streaming
 
     state = load_state()
 
@@ -765,77 +3190,41 @@ def start_file_stream():
         logging.error("STREAM_FILE is not set or is empty. Cannot start file streaming.")
         return
 
-    if os.path.isfile(STREAM_FILE) and not STREAM_FILE.endswith('.txt'):
-        logging.debug(f"Streaming single file: {STREAM_FILE}")
-        file_stream_command = [
-            "ffmpeg",
-            "-re",  # Read input at native frame rate
-            "-stream_loop", "-1",  # Loop the input file indefinitely
-            "-i", str(STREAM_FILE),  # Input file
-            "-c:v", "copy",  # Copy the video codec
-            "-c:a", "aac",  # Audio codec
-            "-strict", "-2",  # Allow experimental codecs
-            "-ac", "2",  # Set number of audio channels
-            "-b:a", "96k",  # Audio bitrate
-            "-ar", "44100",  # Audio sampling rate
-            "-bufsize", "2M",  # Set buffer size for the stream
-            "-f", "flv",  # Output format
-            f"{RTMP_SERVER}{STREAM_KEY}"  # RTMP server URL and stream key
-        ]
-    elif STREAM_FILE.endswith('.txt') and os.path.isfile(STREAM_FILE):
-        logging.debug(f"Streaming playlist file: {STREAM_FILE}")
-        file_stream_command = [
-            "ffmpeg",
-            "-re",  # Read input at native frame rate
-            "-f", "concat",  # Use concat demuxer
-            "-safe", "0",  # Allow unsafe file paths
-            "-stream_loop", "-1",  # Loop the playlist indefinitely
-            "-i", str(STREAM_FILE),  # Input playlist file
-            "-c:v", "copy",  # Copy the video codec
-            "-c:a", "aac",  # Audio codec
-            "-strict", "-2",  # Allow experimental codecs
-            "-ac", "2",  # Set number of audio channels
-            "-b:a", "96k",  # Audio bitrate
-            "-ar", "44100",  # Audio sampling rate
-            "-bufsize", "2M",  # Set buffer size for the stream
-            "-f", "flv",  # Output format
-            f"{RTMP_SERVER}{STREAM_KEY}"  # RTMP server URL and stream key
-        ]
-    else:
-        logging.error(f"{STREAM_FILE} not found or invalid format. Cannot start file streaming.")
+    try:
+        start_max_timer()
+        if STREAM_FILE.endswith('.txt') and os.path.isfile(STREAM_FILE):
+            # Playlists go through the playlist engine so queue edits don't drop the RTMP connection
+            logging.debug(f"Streaming playlist file: {STREAM_FILE}")
+            playlist_engine.load(parse_playlist_file(STREAM_FILE))
+            playlist_engine.start()
+        else:
+            file_stream_supervisor.start()
+    except ValueError as e:
+        logging.error(str(e))
         return
 
-    if REPORT:
-        file_stream_command.insert(1, "-report")  # Insert the -report flag at index 1 in the command list if REPORT is true in the .env file
-
-    start_max_timer()
-
-    file_stream_process = subprocess.Popen(file_stream_command)
     logging.debug("File stream started!")
     file_streaming = True
-    state["recording"] = False
-    state["streaming"] = False
-    state["file_streaming"] = True
-    state["start_time"] = time.time()
-    save_state(state)
+    update_state(recording=False, streaming=False, file_streaming=True, start_time=time.time())
 
 def stop_file_stream():
-    global file_stream_process, file_streaming
+    global file_streaming
 
     state = load_state()
 
     if not state["file_streaming"]:
         return
 
-    if file_stream_process:
-        file_stream_process.terminate()
-        file_stream_process.wait()
-        file_stream_process = None
+    file_stream_supervisor.stop()
+    playlist_engine.stop()
     logging.debug("File stream stopped!")
     file_streaming = False
-    state["file_streaming"] = False
-    state["start_time"] = None
-    save_state(state)
+    update_state(file_streaming=False, start_time=None)
+
+def restart_file_stream():
+    # STREAM_FILE may have changed from a single file to a playlist or the other way round
+    stop_file_stream()
+    start_file_stream()
 
 def shutdown_pi():
     logging.debug("Rebooting...")
@@ -861,8 +3250,8 @@ def restart_service():
         stop_file_stream()
     if stream_recording:
         stop_stream_recording()
-    # Reinitialize the video device before starting the recording
-    reinitialize_device()
+    # Reload the video device only if it is unhealthy, as the start paths do
+    prepare_capture_device()
     # Remove old ffmpeg log files
     remove_ffmpeg_logs(current_directory)
     subprocess.call(['sudo', 'systemctl', 'restart', 'stream_control.service'])
@@ -883,32 +3272,123 @@ def poweroff_pi():
 
 # Function to update the .env file
 def update_env_file(data):
-    # Open the .env file in write mode
-    with open('.env', 'w') as env_file:
-        # Write each key-value pair to the file
-        for key, value in data.items():
-            env_file.write(f"{key}={value}\n")
-            
+    # Raises ValueError (leaving .env untouched) if a setting is invalid
+    with env_file_lock:
+        # Keep settings that are not part of the web form (e.g. STATE_FLUSH_DELAY)
+        env_values = {}
+        if os.path.isfile('.env'):
+            with open('.env', 'r') as env_file:
+                for line in env_file:
+                    key, sep, value = line.rstrip('\n').partition('=')
+                    if sep and key.strip():
+                        env_values[key.strip()] = value
+        env_values.update(data)
+        config = StreamConfig.from_env(env_values)
+        write_env_file(f"{key}={value}\n" for key, value in env_values.items())
+
     # Reload the .env file to update the environment variables
-    load_dotenv()
-    
-    # Update global variables with new values
-    global STREAM_KEY, RTMP_SERVER, ALSA_AUDIO_SOURCE, VIDEO_SIZE, FRAME_RATE, BITRATE, KEYFRAME_INTERVAL, AUDIO_OFFSET, BUFFER_SIZE, STREAM_M3U8_URL, STREAM_FILE, FORMAT, PRESET, REPORT, MAX_TIME
-    STREAM_KEY = os.getenv('STREAM_KEY')
-    RTMP_SERVER = os.getenv('RTMP_SERVER')
-    ALSA_AUDIO_SOURCE = os.getenv('ALSA_AUDIO_SOURCE')
-    VIDEO_SIZE = os.getenv('VIDEO_SIZE')
-    FRAME_RATE = int(os.getenv('FRAME_RATE'))
-    BITRATE = int(os.getenv('BITRATE'))
-    KEYFRAME_INTERVAL = int(os.getenv('KEYFRAME_INTERVAL'))
-    AUDIO_OFFSET = os.getenv('AUDIO_OFFSET')
-    STREAM_M3U8_URL = os.getenv('STREAM_M3U8_URL')
-    STREAM_FILE = os.getenv('STREAM_FILE')
-    BUFFER_SIZE = BITRATE * 2
-    FORMAT = os.getenv('FORMAT')
-    PRESET = os.getenv('PRESET')
-    REPORT = os.getenv('REPORT')
-    MAX_TIME = os.getenv('MAX_TIME')
+    load_dotenv(override=True)
+    return config
+
+# Pipelines that use the capture device and microphone
+CAMERA_PIPELINES = ('stream', 'record')
+# How a changed setting is applied. "hot" settings are read on the next start, "pipeline" settings
+# restart the listed running pipelines, "device" settings also reload the capture device driver.
+CONFIG_CHANGE_ACTIONS = {
+    'STREAM_KEY': ('pipeline', ('stream', 'file_stream', 'playlist', 'relay_primary')),
+    'RTMP_SERVER': ('pipeline', ('stream', 'file_stream', 'playlist', 'relay_primary')),
+    'ALSA_AUDIO_SOURCE': ('pipeline', CAMERA_PIPELINES),
+    'VIDEO_SIZE': ('pipeline', CAMERA_PIPELINES),
+    'FRAME_RATE': ('pipeline', CAMERA_PIPELINES),
+    'BITRATE': ('pipeline', CAMERA_PIPELINES),
+    'KEYFRAME_INTERVAL': ('pipeline', CAMERA_PIPELINES),
+    'AUDIO_OFFSET': ('pipeline', CAMERA_PIPELINES),
+    'PRESET': ('pipeline', CAMERA_PIPELINES),
+    'ENCODER': ('pipeline', CAMERA_PIPELINES),
+    'ENCODER_PROFILE': ('pipeline', CAMERA_PIPELINES),
+    'CAPTURE_PATH': ('pipeline', CAMERA_PIPELINES),
+    'RECORD_SEGMENT_TIME': ('pipeline', CAMERA_PIPELINES),
+    # Some UVC devices only switch pixel format cleanly after a driver reload
+    'FORMAT': ('device', CAMERA_PIPELINES),
+    'STREAM_FILE': ('pipeline', ('file_stream', 'playlist')),
+    'STREAM_M3U8_URL': ('pipeline', ('stream_record',)),
+}
+
+def plan_config_changes(old_config, new_config):
+    # (changed keys, pipelines to restart, whether to reload the capture device)
+    changed = [field.name for field in fields(StreamConfig) if getattr(old_config, field.name) != getattr(new_config, field.name)]
+    restart = set()
+    reload_device = False
+    for key in changed:
+        action, pipelines = CONFIG_CHANGE_ACTIONS.get(key, ('hot', ()))
+        restart.update(pipelines)
+        reload_device = reload_device or action == 'device'
+    return changed, restart, reload_device
+
+def restart_pipelines(names, reason, reload_device=False):
+    active = [supervisor for supervisor in all_supervisors() if supervisor.name in names and supervisor.is_active()]
+    if not reload_device:
+        for supervisor in active:
+            supervisor.restart(reason)
+        return
+
+    capture_device_ready.clear()
+    try:
+        processes = [supervisor.process for supervisor in active]
+        for supervisor in active:
+            supervisor.restart(reason)
+        for process in processes:
+            if process:
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        reload_capture_device(reason)
+    except OSError as e:
+        logging.error(f"Capture device reload failed: {e}")
+    finally:
+        capture_device_ready.set()
+
+def apply_config_changes(old_config, new_config):
+    # Least disruptive way to apply the change; returns a message for the user
+    global encoder_info
+    changed, restart, reload_device = plan_config_changes(old_config, new_config)
+    adaptive_before = adaptive_bitrate.current()
+    apply_config(new_config)
+    if not changed:
+        return "No settings changed."
+
+    if 'ENCODER' in changed:
+        backend, reason = select_encoder_backend(ENCODER, encoder_info["ffmpeg_encoders"], encoder_info["m2m_devices"])
+        encoder_info = dict(encoder_info, backend=backend, reason=reason, requested=ENCODER)
+    stream_supervisor.target_fps = FRAME_RATE
+    record_supervisor.target_fps = FRAME_RATE
+    job_queue.set_workers(new_config.JOB_WORKERS)
+    state_manager.flush_delay = new_config.STATE_FLUSH_DELAY
+    if media_profile() != media_profile(old_config):
+        # Files are checked against the new profile and normalized again
+        Thread(target=media_library.scan, name="media-scan", daemon=True).start()
+    if adaptive_bitrate.current() != adaptive_before:
+        # The adaptive settings moved the stream to a different bitrate or resolution
+        restart.add('stream')
+
+    restart = [name for name in restart if any(supervisor.name == name and supervisor.is_active() for supervisor in all_supervisors())]
+    # With no capture pipeline running, prepare_capture_device() checks the device on the next start
+    reload_device = reload_device and any(name in CAMERA_PIPELINES for name in restart)
+    logging.debug(f"Config changed: {', '.join(changed)}; restarting: {', '.join(restart) or 'nothing'}; device reload: {reload_device}")
+    pipelines = restart
+    if 'STREAM_FILE' in changed and any(name in ('file_stream', 'playlist') for name in restart):
+        # Restarting the old ffmpeg would keep streaming the old file (or the old playlist queue)
+        pipelines = [name for name in restart if name not in ('file_stream', 'playlist')]
+        Thread(target=restart_file_stream).start()
+    if pipelines or reload_device:
+        Thread(target=restart_pipelines, args=(pipelines, f"settings changed: {', '.join(changed)}", reload_device)).start()
+
+    if restart:
+        return f"Config updated. Restarting {', '.join(sorted(restart))} to apply it."
+    if reload_device:
+        return "Config updated. Reloading the capture device."
+    return "Config updated. It applies the next time a stream or recording starts."
 
 @app.route('/')
 def index():
@@ -926,23 +3406,36 @@ def index():
         'FORMAT': os.getenv('FORMAT'),
         'PRESET': os.getenv('PRESET'),
         'REPORT': os.getenv('REPORT'),
-        'MAX_TIME': os.getenv('MAX_TIME')
+        'MAX_TIME': os.getenv('MAX_TIME'),
+        'STREAM_RECORD_MODE': get_stream_record_mode(),
+        'RECORD_MODE': RECORD_MODE,
+        'ENCODER': ENCODER
     }
     state = load_state()
-    recordings = list_recordings()
-    formats, resolutions = parse_v4l2_data_from_file(SYS_INFO_FILE)
-    return render_template('index.html', config=config, state=state, recordings=recordings, formats=formats, resolutions=resolutions)
+    recordings_page = max(request.args.get('page', 1, type=int), 1)
+    recordings_total, recordings = list_recordings(recordings_page)
+    recordings_pages = max((recordings_total + RECORDINGS_PAGE_SIZE - 1) // RECORDINGS_PAGE_SIZE, 1)
+    modes = get_device_modes()
+    if modes:
+        formats = list(modes)
+        resolutions = sorted({size for sizes in modes.values() for size in sizes})
+    else:
+        formats, resolutions = parse_v4l2_data_from_file(SYS_INFO_FILE)
+    return render_template('index.html', config=config, state=state, recordings=recordings, recordings_page=recordings_page, recordings_pages=recordings_pages, formats=formats, resolutions=resolutions, encoder=encoder_info, capture_plan=get_capture_plan(), capabilities=modes, discovering=discovery['status'] == 'discovering')
 
 @app.route('/delete_file', methods=['POST'])
 def delete_file_route():
     directory = request.form['directory']
     filename = request.form['filename']
-    return delete_file(directory, filename)
+    response = delete_file(directory, filename)
+    if os.path.normpath(directory) == RECORDINGS_DIR:
+        recording_catalog.refresh(filename)
+    return response
 
 @app.route('/load_state', methods=['GET'])
 def load_state_endpoint():
     state = load_state()
-    return jsonify(state)
+    return jsonify(dict(state, destinations=simulcast.status()))
 
 @app.route('/toggle_<action>', methods=['POST'])
 def toggle_action(action):
@@ -975,39 +3468,22 @@ def toggle_action(action):
                 stop_file_stream()
         elif action == 'streaming_and_recording':
             if new_state:
-                start_stream()
-                start_stream_recording()
+                start_stream_and_record()
             else:
-                stop_stream()
-                stop_stream_recording()
+                stop_stream_and_record()
 
-        # Reload the state to capture any changes made by the start/stop functions (e.g. start_time)
-        state = load_state()
-
-        # Update the state
-        state[action] = new_state
-        logging.debug(f"Toggled '{action}' to {state[action]}")
+        # Only write the keys this toggle owns so concurrent updates (e.g. remux finishing) are not overwritten
+        changes = {action: new_state}
+        logging.debug(f"Toggled '{action}' to {new_state}")
 
         # Ensure mutual exclusivity
-        if action == 'streaming_and_recording' and new_state:
-            state['streaming'] = False
-            state['recording'] = False
-            state['file_streaming'] = False
-        elif action == 'streaming' and new_state:
-            state['streaming_and_recording'] = False
-            state['recording'] = False
-            state['file_streaming'] = False
-        elif action == 'recording' and new_state:
-            state['streaming_and_recording'] = False
-            state['streaming'] = False
-            state['file_streaming'] = False
-        elif action == 'file_streaming' and new_state:
-            state['streaming_and_recording'] = False
-            state['streaming'] = False
-            state['recording'] = False
+        if new_state:
+            for key in ('streaming_and_recording', 'streaming', 'recording', 'file_streaming'):
+                if key != action:
+                    changes[key] = False
 
+        state = update_state(**changes)
         logging.debug(f"New state after toggle: {state}")
-        save_state(state)
         return jsonify(state), 200
     except Exception as e:
         logging.error(f"Error toggling action '{action}': {e}")
@@ -1016,18 +3492,89 @@ def toggle_action(action):
 @app.route('/update_config', methods=['POST'])
 def update_config():
     data = request.form.to_dict()
-    update_env_file(data)
-    # Create and start a thread to restart the service after a short delay
-    Thread(target=restart_service).start()
-    return jsonify({"message": "Config updated successfully. Restarting service and reloading the browser window."}), 200
+    error = validate_capture_config(data)
+    if error:
+        return jsonify({"message": error}), 400
+    old_config = current_config
+    try:
+        new_config = update_env_file(data)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    return jsonify({"message": apply_config_changes(old_config, new_config)}), 200
+
+def download_rate_limit():
+    # Bytes per second, 0 for no limit
+    if current_config.DOWNLOAD_RATE_LIMIT and (streaming or file_streaming or stream_recording):
+        return current_config.DOWNLOAD_RATE_LIMIT * 1024
+    return 0
+
+def throttle_download(chunks):
+    # Checked per chunk, so starting a stream slows a running download
+    last = time.monotonic()
+    try:
+        for chunk in chunks:
+            yield chunk
+            limit = download_rate_limit()
+            if limit:
+                wait = len(chunk) / limit - (time.monotonic() - last)
+                if wait > 0:
+                    time.sleep(wait)
+            last = time.monotonic()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
 
 @app.route('/recordings/<filename>')
 def serve_recording(filename):
     file_path = os.path.join('recordings', filename)
-    if os.path.exists(file_path):
-        return send_file(file_path, mimetype='video/mp4')
-    else:
+    if not os.path.isfile(file_path):
         abort(404)
+    # conditional=True answers Range/If-Range with 206 partial content and ETag/If-None-Match with 304
+    response = send_file(file_path, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                         conditional=True, etag=True, max_age=0, as_attachment=request.args.get('download') == '1')
+    if current_config.DOWNLOAD_RATE_LIMIT and response.status_code in (200, 206):
+        response.response = throttle_download(response.response)
+    return response
+
+@app.route('/thumbnails/<filename>')
+def serve_thumbnail(filename):
+    file_path = os.path.join(THUMBNAIL_DIR, filename)
+    if not os.path.isfile(file_path):
+        abort(404)
+    return send_file(file_path, mimetype='image/jpeg', conditional=True, max_age=3600)
+
+@app.route('/api/recordings')
+def api_recordings():
+    # ?page=1&per_page=50&sort=modified|size|filename|duration&order=desc|asc
+    try:
+        page = int(request.args.get('page', 1))
+        per_page = int(request.args.get('per_page', RECORDINGS_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "page and per_page must be numbers"}), 400
+    sort = request.args.get('sort', 'modified')
+    if sort not in RECORDING_SORT_COLUMNS:
+        return jsonify({"error": f"sort must be one of {', '.join(RECORDING_SORT_COLUMNS)}"}), 400
+    total, recordings = list_recordings(page, per_page, sort, request.args.get('order', 'desc'))
+    return jsonify({"total": total, "page": max(page, 1), "per_page": max(1, min(per_page, 500)), "recordings": recordings})
+
+@app.route('/concat_recordings', methods=['POST'])
+def concat_recordings_route():
+    # In the order given
+    filenames = [os.path.basename(name) for name in request.form.getlist('filenames') if name]
+    recording_files = [os.path.join('recordings', name) for name in filenames]
+    if len(recording_files) < 2:
+        return jsonify({"message": "Select at least two recordings to join."}), 400
+    missing = [name for name, path in zip(filenames, recording_files) if not os.path.isfile(path)]
+    if missing:
+        return jsonify({"message": f"Recording not found: {', '.join(missing)}"}), 404
+
+    output_file = os.path.join('recordings', f"{os.path.splitext(filenames[0])[0]}_joined.mp4")
+    job = job_queue.submit("concat", recording_files, output_file)
+    return jsonify({"message": f"Joining {len(recording_files)} recordings into {os.path.basename(output_file)}.", "job": job["id"]}), 202
+
+@app.route('/jobs')
+def get_jobs():
+    return jsonify(job_queue.list())
 
 @app.route('/start_stream', methods=['POST'])
 def start_stream_route():
@@ -1041,8 +3588,7 @@ def stop_stream_route():
 
 @app.route('/start_stream_record', methods=['POST'])
 def start_stream_record_route():
-    start_stream()
-    start_stream_recording()
+    start_stream_and_record()
     return jsonify({"message": "Stream and recording started."}), 200
 
 @app.route('/stop_stream_record', methods=['POST'])
@@ -1083,6 +3629,107 @@ def stop_file_stream_route():
     stop_file_stream()
     return jsonify({"message": "File stream stopped."}), 200
 
+@app.route('/adaptive_bitrate')
+def get_adaptive_bitrate():
+    return jsonify(adaptive_bitrate.status())
+
+@app.route('/destinations')
+def get_destinations():
+    # Stream keys are masked
+    return jsonify(simulcast.status())
+
+@app.route('/destinations', methods=['POST'])
+def save_destination_route():
+    # Adds a destination or updates the one with the given id
+    destination_id = request.form.get('id') or re.sub(r'[^a-z0-9]+', '_', request.form.get('name', '').lower()).strip('_')
+    if not destination_id or destination_id == 'primary':
+        return jsonify({"message": "Give the destination a name. The primary destination is set with RTMP Server and Stream Key."}), 400
+    destinations = simulcast.load()
+    destination = next((destination for destination in destinations if destination["id"] == destination_id), None)
+    if destination is None:
+        destination = {"id": destination_id, "name": request.form.get('name') or destination_id, "rtmp_server": '', "stream_key": '', "enabled": True}
+        destinations.append(destination)
+    for key in ('name', 'rtmp_server', 'stream_key'):
+        if request.form.get(key):
+            destination[key] = request.form[key]
+    if 'enabled' in request.form:
+        destination["enabled"] = request.form['enabled'].lower() in ('1', 'true', 'on', 'yes')
+    if not re.match(r'rtmps?://', destination["rtmp_server"]):
+        return jsonify({"message": "rtmp_server must start with rtmp:// or rtmps://"}), 400
+    simulcast.save(destinations)
+    simulcast.sync()
+    return jsonify({"message": f"Destination {destination['name']} saved.", "id": destination_id}), 200
+
+@app.route('/destinations/remove', methods=['POST'])
+def remove_destination_route():
+    destination_id = request.form.get('id')
+    destinations = simulcast.load()
+    remaining = [destination for destination in destinations if destination["id"] != destination_id]
+    if len(remaining) == len(destinations):
+        return jsonify({"message": f"No destination {destination_id}."}), 404
+    simulcast.save(remaining)
+    simulcast.sync()
+    return jsonify({"message": f"Destination {destination_id} removed."}), 200
+
+@app.route('/media')
+def get_media():
+    return jsonify({"profile": media_profile(), "files": media_library.status()})
+
+@app.route('/media/scan', methods=['POST'])
+def media_scan_route():
+    Thread(target=media_library.scan, name="media-scan", daemon=True).start()
+    return jsonify({"message": "Scanning media. Files that need normalizing are added to the job queue."}), 202
+
+@app.route('/playlist')
+def get_playlist():
+    return jsonify(playlist_engine.status())
+
+@app.route('/playlist/append', methods=['POST'])
+def playlist_append_route():
+    path = request.form.get('path', '')
+    if not os.path.isfile(path):
+        return jsonify({"message": f"{path} not found."}), 404
+    item = playlist_engine.append(path)
+    return jsonify({"message": f"Added {item['name']}.", "item": item}), 200
+
+@app.route('/playlist/import', methods=['POST'])
+def playlist_import_route():
+    # STREAM_FILE unless a path is given
+    path = request.form.get('path') or STREAM_FILE
+    if not path or not os.path.isfile(path):
+        return jsonify({"message": f"{path} not found."}), 404
+    playlist_engine.load(parse_playlist_file(path))
+    if playlist_engine.is_active():
+        # The item playing now is no longer in the queue, move on to the first imported one
+        playlist_engine.skip()
+    return jsonify({"message": f"Imported {len(playlist_engine.items)} items from {path}."}), 200
+
+@app.route('/playlist/skip', methods=['POST'])
+def playlist_skip_route():
+    playlist_engine.skip()
+    return jsonify({"message": "Skipped to the next item."}), 200
+
+@app.route('/playlist/shuffle', methods=['POST'])
+def playlist_shuffle_route():
+    playlist_engine.shuffle()
+    return jsonify({"message": "Playlist shuffled."}), 200
+
+@app.route('/playlist/move', methods=['POST'])
+def playlist_move_route():
+    try:
+        playlist_engine.move(int(request.form['id']), int(request.form['index']))
+    except (KeyError, ValueError) as e:
+        return jsonify({"message": f"Invalid move: {e}"}), 400
+    return jsonify({"message": "Playlist reordered."}), 200
+
+@app.route('/playlist/remove', methods=['POST'])
+def playlist_remove_route():
+    try:
+        playlist_engine.remove(int(request.form['id']))
+    except (KeyError, ValueError) as e:
+        return jsonify({"message": f"Invalid item: {e}"}), 400
+    return jsonify({"message": "Removed from the playlist."}), 200
+
 @app.route('/reboot', methods=['POST'])
 def shutdown_route():
     shutdown_pi()
@@ -1119,9 +3766,7 @@ def get_disk_usage():
 @app.route('/get_log')
 def get_log():
     try:
-        last_100_lines = get_last_n_lines(log_file_path, 100)
-        log_content = ''.join(last_100_lines)
-        return jsonify({'log': log_content})
+        return get_log_response(log_file_path)
     except Exception as e:
         return jsonify({'error': str(e)})
 
@@ -1131,18 +3776,226 @@ def get_ffmpeg_log():
         latest_log_file_path = get_latest_ffmpeg_log(current_directory)
         if latest_log_file_path is None:
             return jsonify({'error': 'No log files found.'})
-        
-        last_100_lines = get_last_n_lines(latest_log_file_path, 100)
-        latest_log_file = ''.join(last_100_lines)
-        
-        return jsonify({'log': latest_log_file})
+
+        return get_log_response(latest_log_file_path)
     except Exception as e:
         return jsonify({'error': str(e)})
 
 @app.route('/get_cpu_stats')
 def get_cpu_stats():
-    usage_json = display_usage()
-    return jsonify(json.loads(usage_json))
+    usage_data = get_usage_data()
+    window = request.args.get('window', type=int)
+    if window:
+        # Short history for sparklines, capped at what the sampler keeps
+        usage_data['history'] = system_sampler.history(min(window, SAMPLE_HISTORY * SAMPLE_INTERVAL))
+    return jsonify(usage_data)
+
+@app.route('/encoders')
+def get_encoders():
+    return jsonify(encoder_info)
+
+@app.route('/discovery_status')
+def discovery_status():
+    return jsonify(discovery)
+
+@app.route('/capabilities')
+def get_capabilities():
+    return jsonify(capability_index)
+
+@app.route('/capture_plan')
+def get_capture_plan_route():
+    return jsonify(get_capture_plan())
+
+@app.route('/pipelines')
+def get_pipelines():
+    return jsonify({supervisor.name: supervisor.status() for supervisor in all_supervisors()})
+
+@app.route('/metrics/encoder')
+def get_encoder_metrics():
+    with encoder_metrics_lock:
+        return jsonify({name: dict(metrics) for name, metrics in encoder_metrics.items()})
+
+def prometheus_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{key}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+def prometheus_metric(lines, name, metric_type, help_text, samples):
+    # samples is a list of (labels, value)
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {metric_type}")
+    for labels, value in samples:
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = int(value)
+        lines.append(f"{name}{prometheus_labels(labels)} {value}")
+
+@app.route('/metrics')
+def prometheus_metrics():
+    lines = []
+    now = time.time()
+
+    usage_data = get_usage_data()
+    prometheus_metric(lines, "raspi_streamer_cpu_usage_percent", "gauge", "Total CPU usage.", [({}, usage_data["cpu_usage"])])
+    prometheus_metric(lines, "raspi_streamer_cpu_core_usage_percent", "gauge", "CPU usage per core.",
+                      [({"core": core}, value) for core, value in enumerate(usage_data["cpu_per_core"])])
+    prometheus_metric(lines, "raspi_streamer_memory_usage_percent", "gauge", "Memory usage.", [({}, usage_data["memory_usage_percent"])])
+    prometheus_metric(lines, "raspi_streamer_memory_available_bytes", "gauge", "Available memory.", [({}, int(usage_data["memory_available_mb"] * 1024 * 1024))])
+    prometheus_metric(lines, "raspi_streamer_memory_total_bytes", "gauge", "Total memory.", [({}, int(usage_data["memory_total_mb"] * 1024 * 1024))])
+    prometheus_metric(lines, "raspi_streamer_temperature_celsius", "gauge", "SoC temperature.", [({}, usage_data["temperature_c"])])
+    throttled = usage_data["throttled"]
+    prometheus_metric(lines, "raspi_streamer_throttled", "gauge", "Firmware throttling flags (1 when set).",
+                      [({"flag": flag}, flag in throttled["flags"]) for flag in THROTTLE_FLAGS.values()] if throttled else [])
+
+    disk_data = disk_usage()
+    mounts = disk_data.get("mounts", [])
+    prometheus_metric(lines, "raspi_streamer_disk_size_bytes", "gauge", "Filesystem size.",
+                      [({"mountpoint": mount["mounted_on"], "device": mount["filesystem"]}, mount["size_bytes"]) for mount in mounts])
+    prometheus_metric(lines, "raspi_streamer_disk_available_bytes", "gauge", "Filesystem space available.",
+                      [({"mountpoint": mount["mounted_on"], "device": mount["filesystem"]}, mount["available_bytes"]) for mount in mounts])
+    prometheus_metric(lines, "raspi_streamer_recording_minutes_remaining", "gauge", "Recording minutes left on the recordings filesystem at BITRATE.",
+                      [({}, disk_data.get("recording_minutes_remaining"))])
+
+    state = load_state()
+    prometheus_metric(lines, "raspi_streamer_state", "gauge", "Stream state flags (1 when active).",
+                      [({"flag": key}, value) for key, value in state.items() if isinstance(value, bool)])
+
+    with encoder_metrics_lock:
+        metrics = {name: dict(values) for name, values in encoder_metrics.items()}
+        starts = dict(pipeline_starts)
+    prometheus_metric(lines, "raspi_streamer_ffmpeg_up", "gauge", "Whether the pipeline's ffmpeg is running.",
+                      [({"pipeline": name}, values.get("running")) for name, values in metrics.items()])
+    prometheus_metric(lines, "raspi_streamer_ffmpeg_uptime_seconds", "gauge", "Seconds since the pipeline's ffmpeg was started.",
+                      [({"pipeline": name}, round(now - values["started_at"], 3)) for name, values in metrics.items() if values.get("running") and values.get("started_at")])
+    prometheus_metric(lines, "raspi_streamer_ffmpeg_starts_total", "counter", "Number of times the pipeline's ffmpeg was launched.",
+                      [({"pipeline": name}, count) for name, count in starts.items()])
+    abr_status = adaptive_bitrate.status()
+    prometheus_metric(lines, "raspi_streamer_adaptive_bitrate_kbps", "gauge", "Video bitrate the stream pipeline is using.", [({}, abr_status["bitrate"])])
+    prometheus_metric(lines, "raspi_streamer_adaptive_level", "gauge", "Step on the adaptive bitrate ladder (0 is BITRATE).", [({}, abr_status["level"])])
+    prometheus_metric(lines, "raspi_streamer_stream_send_backlog_bytes", "gauge", "Bytes waiting in the RTMP socket send queue.",
+                      [({}, abr_status["sample"].get("backlog_bytes"))])
+    prometheus_metric(lines, "raspi_streamer_adaptive_changes_total", "counter", "Adaptive bitrate changes by method.",
+                      [({"method": method}, costs["count"]) for method, costs in abr_status["costs"].items()])
+    with capture_device_lock:
+        device_stats = dict(capture_device_stats)
+    prometheus_metric(lines, "raspi_streamer_capture_device_checks_total", "counter", "Capture device health checks before a start.", [({}, device_stats["checks"])])
+    prometheus_metric(lines, "raspi_streamer_capture_device_reloads_total", "counter", "uvcvideo module reloads.", [({}, device_stats["reloads"])])
+    prometheus_metric(lines, "raspi_streamer_capture_device_check_seconds", "gauge", "Duration of the last capture device health check.", [({}, device_stats["last_check_seconds"])])
+    prometheus_metric(lines, "raspi_streamer_capture_device_reload_seconds", "gauge", "Duration of the last uvcvideo reload.", [({}, device_stats["last_reload_seconds"])])
+    prometheus_metric(lines, "raspi_streamer_capture_device_failures", "gauge", "Capture pipeline failures in a row.", [({}, device_stats["consecutive_failures"])])
+    prometheus_metric(lines, "raspi_streamer_ffmpeg_restarts_total", "counter", "Number of times the supervisor restarted the pipeline's ffmpeg.",
+                      [({"pipeline": supervisor.name}, supervisor.restarts) for supervisor in all_supervisors()])
+    for key, metric_name, metric_type, help_text in (
+        ("fps", "raspi_streamer_encoder_fps", "gauge", "Frames per second reported by ffmpeg."),
+        ("target_fps", "raspi_streamer_encoder_target_fps", "gauge", "Configured FRAME_RATE for capture pipelines."),
+        ("bitrate_kbps", "raspi_streamer_encoder_bitrate_kbps", "gauge", "Output bitrate reported by ffmpeg."),
+        ("speed", "raspi_streamer_encoder_speed", "gauge", "Encoding speed relative to real time."),
+        ("frame", "raspi_streamer_encoder_frames_total", "counter", "Frames processed."),
+        ("drop_frames", "raspi_streamer_encoder_dropped_frames_total", "counter", "Frames dropped."),
+        ("dup_frames", "raspi_streamer_encoder_duplicated_frames_total", "counter", "Frames duplicated."),
+        ("total_size", "raspi_streamer_encoder_output_bytes_total", "counter", "Bytes written to the output."),
+    ):
+        prometheus_metric(lines, metric_name, metric_type, help_text,
+                          [({"pipeline": name}, values.get(key)) for name, values in metrics.items()])
+
+    with request_latency_lock:
+        latency = {route: {"buckets": list(stats["buckets"]), "count": stats["count"], "sum": stats["sum"]} for route, stats in request_latency.items()}
+    lines.append("# HELP raspi_streamer_request_duration_seconds Flask request latency by route.")
+    lines.append("# TYPE raspi_streamer_request_duration_seconds histogram")
+    for route, stats in sorted(latency.items()):
+        for bound, count in zip(LATENCY_BUCKETS, stats["buckets"]):
+            lines.append(f"raspi_streamer_request_duration_seconds_bucket{prometheus_labels({'route': route, 'le': bound})} {count}")
+        lines.append(f"raspi_streamer_request_duration_seconds_bucket{prometheus_labels({'route': route, 'le': '+Inf'})} {stats['count']}")
+        lines.append(f"raspi_streamer_request_duration_seconds_sum{prometheus_labels({'route': route})} {stats['sum']:.6f}")
+        lines.append(f"raspi_streamer_request_duration_seconds_count{prometheus_labels({'route': route})} {stats['count']}")
+
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+# Seconds between CPU/memory/disk/log checks on the /events stream
+EVENTS_SAMPLE_INTERVAL = 5
+# Seconds between keep-alive comments so proxies do not close idle streams
+EVENTS_KEEPALIVE = 15
+
+def sse_message(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/events')
+def events():
+    # Server-Sent Events: state, stats, disk and log tails
+    def stream():
+        state_version = None
+        last_destinations = None
+        last_usage = None
+        last_disk = None
+        log_offset = None
+        ffmpeg_log_path = None
+        ffmpeg_log_offset = None
+        next_sample = 0
+        last_message = time.time()
+
+        while True:
+            version, state = state_manager.wait_for_change(state_version, timeout=1)
+            destinations = simulcast.status()
+            # The same payload as /load_state. Byte and bitrate counters alone do not warrant a push.
+            destination_values = [{key: value for key, value in destination.items() if key not in ('bytes_sent', 'bitrate_kbps')}
+                                  for destination in destinations]
+            if version != state_version or destination_values != last_destinations:
+                state_version = version
+                last_destinations = destination_values
+                yield sse_message('state', dict(state, destinations=destinations))
+                last_message = time.time()
+
+            now = time.time()
+            if now < next_sample:
+                if now - last_message >= EVENTS_KEEPALIVE:
+                    yield ": keep-alive\n\n"
+                    last_message = now
+                continue
+            next_sample = now + EVENTS_SAMPLE_INTERVAL
+
+            messages = []
+
+            usage_data = get_usage_data()
+            # Every sample has a new timestamp, only push when a value changed
+            usage_values = {key: value for key, value in usage_data.items() if key != 'timestamp'}
+            if usage_values != last_usage:
+                last_usage = usage_values
+                messages.append(sse_message('stats', usage_data))
+
+            disk_data = disk_usage()
+            if disk_data != last_disk:
+                last_disk = disk_data
+                messages.append(sse_message('disk', disk_data))
+
+            try:
+                text, log_offset, reset = read_log_since(log_file_path, log_offset)
+                if text or reset:
+                    messages.append(sse_message('log', {'log': text, 'reset': reset}))
+            except OSError as e:
+                logging.error(f"Error reading log for events: {e}")
+
+            latest_log_file_path = get_latest_ffmpeg_log(current_directory)
+            if latest_log_file_path:
+                if latest_log_file_path != ffmpeg_log_path:
+                    ffmpeg_log_path = latest_log_file_path
+                    ffmpeg_log_offset = None
+                try:
+                    text, ffmpeg_log_offset, reset = read_log_since(ffmpeg_log_path, ffmpeg_log_offset)
+                    if text or reset:
+                        messages.append(sse_message('ffmpeg_log', {'log': text, 'reset': reset}))
+                except OSError as e:
+                    logging.error(f"Error reading ffmpeg log for events: {e}")
+
+            if messages:
+                yield ''.join(messages)
+                last_message = time.time()
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # PWA Support
 @app.route('/manifest.json')
@@ -1157,6 +4010,56 @@ def serve_sw():
 def run_flask_app():
     app.run(host='0.0.0.0', port=5000)
 
-# Start the Flask app in a separate thread
-flask_thread = Thread(target=run_flask_app)
-flask_thread.start()
\ No newline at end of file
+def timed_probe(name, function, *args):
+    started = time.time()
+    try:
+        return function(*args)
+    finally:
+        discovery["timings"][name] = round(time.time() - started, 3)
+
+def run_discovery():
+    # Probes run concurrently while the web server is already answering
+    global capability_index, encoder_info
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        arecord = executor.submit(timed_probe, 'arecord', get_command_output, ['arecord', '-l'])
+        lsusb = executor.submit(timed_probe, 'lsusb', get_command_output, ['lsusb'])
+        v4l2 = executor.submit(timed_probe, 'v4l2-ctl', get_command_output, ['v4l2-ctl', '--list-formats-ext'])
+        encoders = executor.submit(timed_probe, 'encoders', probe_encoders)
+        capabilities = executor.submit(timed_probe, 'capabilities', build_capability_index, lambda: parse_v4l2_modes(v4l2.result()))
+        ffmpeg_logs = executor.submit(timed_probe, 'ffmpeg_logs', remove_ffmpeg_logs, current_directory)
+        recordings = executor.submit(timed_probe, 'recordings', recording_catalog.sync)
+
+        # arecord -l is run once and used both for the audio device and the system info
+        apply_audio_device(arecord.result())
+        write_system_info([("lsusb", lsusb.result()), ("arecord -l", arecord.result()), ("v4l2-ctl --list-formats-ext", v4l2.result())])
+        capability_index = capabilities.result()
+        encoder_info = encoders.result()
+        ffmpeg_logs.result()
+        recordings.result()
+
+    discovery["timings"]["total"] = round(time.time() - started, 3)
+    discovery["status"] = "ready"
+    discovery_complete.set()
+    # Hashing new media files can take a while, so it runs after startup
+    Thread(target=media_library.scan, name="media-scan", daemon=True).start()
+    logging.info("Startup timings: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in discovery["timings"].items()))
+
+def run_discovery_safely():
+    try:
+        run_discovery()
+    except Exception as e:
+        logging.error(f"Hardware discovery failed: {e}")
+        discovery["status"] = "failed"
+        discovery_complete.set()
+
+def main():
+    # Start the Flask app in a separate thread, before the (slower) hardware discovery
+    flask_thread = Thread(target=run_flask_app)
+    flask_thread.start()
+    discovery["timings"]["http_server"] = round(time.time() - startup_started, 3)
+    logging.info(f"Web server started {discovery['timings']['http_server']:.2f}s after launch")
+    Thread(target=run_discovery_safely, daemon=True).start()
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file